@@ -1,6 +1,28 @@
+import os
 import random
 import socket as sck
 import math
+import struct
+import zlib
+import sys
+import argparse
+import asyncio
+import itertools
+import io
+import json
+import time
+import platform
+import shutil
+import statistics
+import threading
+import queue
+import contextlib
+import atexit
+import functools
+import mmap
+import concurrent.futures
+from array import array
+from collections import deque, defaultdict, OrderedDict
 
 #####################################################################################################################
 #       IMPORTANT NOTE                                                                                              #
@@ -12,20 +34,54 @@ import math
 #####################################################################################################################
 
 MULTI_PORT = 8390
-DUNGEON_SIZE = 25  # Dungeon grid size per side
+SPECTATOR_PORT = 8391  # Match server port for spectators
+SPECTATOR_BUFFER = 1 << 16  # Bytes a spectator may have unsent, besides a map, before it stops getting updates
+IDLE_TIMEOUT = 600  # Seconds the match server waits on a silent or stalled connection before dropping it
+TURN_TIMER = None  # Seconds to act in a multiplayer turn before standing still, or None to wait. Set with --turn-timer
+HUNTING = False  # Whether monsters hunt the player down in new games. Set with --hunt
+SEED_HANDSHAKE = True  # Send the client only the seed. If False, or it can't rebuild the same map, the grid is sent
+DUNGEON_SIZE = 25  # Default dungeon grid size per side
+ANSI_MARGIN = 12  # Lines a turn may print below an ANSI frame. On shorter terminals every frame is drawn whole
 DUNGEON_SIGHT = 6  # Player is shown nearby [x - sight, x + sight] x [y - sight, y + sight] cells
+HUNT_RANGE = DUNGEON_SIGHT  # Steps from which hunting monsters come after the player
+HUNT_BITE_CHANCE = 0.5  # The probability that a hunting monster next to the player bites it, for 1 health point
+HUNT_PACE = 2  # Hunting monsters take a step every this many turns, so the player can outrun them
+SIGHT_CACHED = 1024  # Rooms whose field of view is kept, the least recently used ones are dropped first
 STUP_DST = 10  # The minimum distance between players and exit during setup
 STUP_TOL = 10  # The number of possible setup failures before decreasing the minimum distance.
+STUP_BLOCK = 3  # Rooms per side each player and the exit get at least in spawn_spaced, which bounds players per size
 CORRIDOR_BIAS = 0.4  # The probability by which the drunken path will go straight
 CORRIDOR_CM_BIAS = (1 - CORRIDOR_BIAS) / 3  # Complementary corridor bias. The probability of all other sides.
 DRUNK_LIMIT = 200  # The max number of cell explorable during drunken walk
 DRUNK_CHANCE = 0.3  # The probability that when connecting a cell and the exit, a drunken walk will be performed
+DRUNK_ATTEMPTS = 4  # A drunken walk of limit cells gives up after limit * DRUNK_ATTEMPTS tries, even if stuck
+LAYOUTS = {"drunk": "carve_drunk", "rooms": "carve_rooms", "caves": "carve_caves"}  # Layout name -> DungeonGraph method
+DUNGEON_LAYOUT = "drunk"  # Layout of new dungeons. Set with --layout
+SEED_LAYOUT = "drunk"  # Only this layout is rebuilt from the seed in the handshake, the others send the whole map
+LAYOUT_BUDGET = 1500000  # Cells a layout may carve, about half a second. Spawning and furnishing aren't counted
+ROOM_MIN = 3  # Smallest room side in the rooms layout
+ROOM_BLOCK = 12  # The rooms layout splits the grid until blocks are at most this long, then makes a room in each
+CAVE_STEPS = 4  # Smoothing passes of the caves layout. Each makes a wall of the cells with 5 or more walls around them
+ENDLESS_CHUNK = 32  # Chunk size per side in the endless dungeon
+ENDLESS_CACHED = 64  # Chunks kept in memory in the endless dungeon. The least recently used ones are dropped first
+ENDLESS_EDITED = 1024  # Chunks whose changed rooms are remembered. The least recently changed ones are forgotten first
+ENDLESS_EXIT_CHUNKS = 6  # Chunks between the starting one and the one with the exit in the endless dungeon
 
 PC_MNST = 0.05  # Percentage of monsters over the free cells
 PC_TRAP = 0.05  # Percentage of traps
 PC_QUIZ = 0.025  # Percentage of quizzes
 PC_CHEST = 0.05  # Percentage of chests
 
+TRAP_AVOID_CHANCE = 0.5  # The probability of noticing a trap before it goes off
+GAS_CHANCE = 0.5  # The probability that a trap or a wrong answer releases poison gas rather than opening a pit
+TREASURE_MIN = 10  # Coins found in a chest or behind a solved quiz, from TREASURE_MIN to TREASURE_MAX - 1
+TREASURE_MAX = 100
+MONSTER_HP_MAX = 2  # Monsters have from 1 to MONSTER_HP_MAX health points
+SWORD_DAMAGE = 3  # Health points a sword blow takes. Bare hands take 1
+ENTITY_SALT = 1 << 41  # Offsets the entity seed from the dungeon one, so their random streams differ
+TRAP_GAS = 1  # Kinds of trap
+TRAP_PIT = 2
+
 RM_WALL = '#'  # All the map symbols
 RM_EMPTY = ' '
 RM_PLAYER = '@'
@@ -42,35 +98,500 @@ RM_LOCKP = 'l'
 RM_COMP = 'C'
 RM_SWRD = 's'
 
-MSG_DIE = "DEAD"
-MSG_ESC = "ESCAPE"
-MSG_CLR = "CLEAR"
-MSG_POS = "POS"
+MSG_DIE = 1  # Message types of the turn protocol. Fields of each type are laid out in MSG_LAYOUTS
+MSG_ESC = 2
+MSG_CLR = 3
+MSG_POS = 4
+MSG_SAY = 5  # Encounter messages
+MSG_ATK = 6
+MSG_STL = 7
+MSG_COIN = 8
+MSG_LUCK = 9
+MSG_SEAT = 10  # Spectators only: the following messages come from this seat
+MSG_SNAP = 11  # Spectators only: a map handshake follows, to start over from
+MSG_HIT = 12  # Monster hurt but still standing
+MSG_MNST = 13  # Monster walked into a room, the one it left is cleared with MSG_CLR
+MSG_NEAR = 14  # Arena only: another player in sight, besides the stranger. Only drawn
 
 DIRECTIONS = ("Nord-Ovest", "Nord", "Nord-Est", "Est", "Sud-Est", "Sud", "Sud-Ovest")
 
-cheats_enabled = False
+WALK_DIRS = ((0, 1), (-1, 0), (0, -1), (1, 0))  # East, North, West, South. Remember it's (row, column)
+WALK_WEIGHTS = (CORRIDOR_BIAS, CORRIDOR_BIAS + CORRIDOR_CM_BIAS, CORRIDOR_BIAS + 2 * CORRIDOR_CM_BIAS, 1)  # Cumulative
+
+ROOM_CHARS = [chr(i) for i in range(256)]  # Grid byte -> room symbol lookup, faster than calling chr() on each get
+
+
+# Builds each frame in memory and writes it out with a single call. In ANSI mode only the cells and UI lines that
+# changed since the last frame are repainted, by moving the cursor over them; the frame is anchored to the top of
+# the screen and anything printed afterwards goes below it. That only holds while nothing scrolls: if the frame
+# and ANSI_MARGIN lines don't fit the terminal height, or its lines wrap, the screen is cleared and redrawn instead.
+class FrameRenderer:
+    def __init__(self, ansi=False):
+        self.ansi = ansi
+        self.last = None  # Last frame drawn in ANSI mode
+
+        if ansi and os.name == "nt":
+            os.system("")  # Enables escape codes on the Windows console
+
+    # Draw a frame given as a list of (symbols, UI line) rows
+    def draw(self, rows):
+        width = len(rows[0][0]) if rows else 0
+
+        if not self.ansi:
+            out = self.compose(rows, width)
+        elif self.last is None or len(self.last) != len(rows) or len(self.last[0][0]) != width or \
+                not self.fits(rows, width):
+            out = "\x1b[H\x1b[2J" + self.compose(rows, width)  # First frame, different shape or scrolling: redraw
+        else:
+            changes = []
+            for i, ((symbols, ui_line), (last_symbols, last_ui_line)) in enumerate(zip(rows, self.last)):
+                line = 2 * i + 2  # Screen lines are 1-based and every row follows a rule
+                for j in range(width):
+                    if symbols[j] != last_symbols[j]:
+                        changes.append("\x1b[%d;%dH%s" % (line, 4 * j + 3, symbols[j]))
+                if ui_line != last_ui_line:
+                    changes.append("\x1b[%d;%dH%s\x1b[K" % (line, 4 * width + 2, ui_line))
+
+            # Move below the frame and clear what the last turn printed there
+            changes.append("\x1b[%d;1H\x1b[J" % (2 * len(rows) + 2))
+            out = "".join(changes)
+
+        if self.ansi:
+            self.last = [(list(symbols), ui_line) for symbols, ui_line in rows]
+
+        sys.stdout.write(out)
+        sys.stdout.flush()
+
+    # Whether the frame and ANSI_MARGIN lines below it fit the terminal, without wrapping
+    @staticmethod
+    def fits(rows, width):
+        columns, lines = shutil.get_terminal_size()
+        longest = max((len((" " * (4 * width + 1) + ui_line).expandtabs()) for _, ui_line in rows), default=0)
+        return 2 * len(rows) + 1 + ANSI_MARGIN <= lines and longest <= columns
+
+    @staticmethod
+    def compose(rows, width):
+        rule = " " + "--- " * width + "\n"
+        out = [rule]
+        for symbols, ui_line in rows:
+            out.append("| " + " | ".join(symbols) + " |" + ui_line + "\n")
+            out.append(rule)
+        return "".join(out)
+
+
+renderer = FrameRenderer()
+
+
+# Distance in steps from every room to the nearest exit, walking through anything but walls. The BFS runs on the first
+# query and is then kept up to date by DungeonGraph.set: opening a room or adding an exit only relaxes the distances
+# around it, while closing a room or removing an exit drops the field until the next query.
+class DistanceField:
+    UNREACHABLE = -1
+
+    def __init__(self, dungeon):
+        self.dungeon = dungeon
+        self.dist = None  # Distance per grid index, or None if it has to be computed again
+
+    def invalidate(self):
+        self.dist = None
+
+    # Distance of the given grid index, computing the field if needed
+    def get(self, idx):
+        if self.dist is None:
+            self.compute()
+        return self.dist[idx]
+
+    def compute(self):
+        data = self.dungeon.data
+        self.dist = array("i", [self.UNREACHABLE]) * len(data)
+        exit_room = ord(RM_EXIT)
+
+        exits = []
+        idx = data.find(exit_room)
+        while idx != -1:
+            self.dist[idx] = 0
+            exits.append(idx)
+            idx = data.find(exit_room, idx + 1)
+
+        self.relax(exits)
+
+    # Called by DungeonGraph.set when the room at idx changes from old to new (both as bytes)
+    def room_changed(self, idx, old, new):
+        if self.dist is None:
+            return
+
+        wall, exit_room = ord(RM_WALL), ord(RM_EXIT)
+        if new == wall or (old == exit_room and new != exit_room):
+            self.dist = None  # Distances can only grow: recompute them lazily
+        elif new == exit_room:
+            self.dist[idx] = 0
+            self.relax([idx])
+        elif old == wall:
+            # Newly opened room: reach it from its best neighbour, then see if it shortens any path
+            near = [self.dist[n] for n in self.neighbours(idx) if self.dist[n] != self.UNREACHABLE]
+            if near:
+                self.dist[idx] = min(near) + 1
+                self.relax([idx])
+
+    # BFS from the given indexes, lowering the distance of every walkable room that can be reached faster through them
+    def relax(self, sources):
+        dist = self.dist
+        data = self.dungeon.data
+        wall = ord(RM_WALL)
+        queue = deque(sources)
+
+        while queue:
+            idx = queue.popleft()
+            step = dist[idx] + 1
+            for n in self.neighbours(idx):
+                if data[n] != wall and (dist[n] == self.UNREACHABLE or dist[n] > step):
+                    dist[n] = step
+                    queue.append(n)
+
+    def neighbours(self, idx):
+        size = self.dungeon.size
+        y = idx % size
+        if idx >= size:
+            yield idx - size
+        if idx < len(self.dungeon.data) - size:
+            yield idx + size
+        if y > 0:
+            yield idx - 1
+        if y < size - 1:
+            yield idx + 1
+
+
+# Dungeon contents
+# Indexes of every room of the given kind in a grid, in order, found at C speed
+def room_indexes(data, room):
+    room = ord(room)
+    idx = data.find(room)
+    while idx != -1:
+        yield idx
+        idx = data.find(room, idx + 1)
+
+
+# What's in the rooms besides their kind: monster health, chest coins and trap kinds. One dict per property, keyed by
+# grid index, so there's no object per monster, chest or trap, a lookup is a single index and memory only grows with the
+# rooms that hold something, not with the grid. Rooms never stocked read as 0. An entry only means something while its
+# room is of the matching kind: clearing a room leaves it there, stale.
+# Entities are drawn from the grid and the dungeon seed alone, so whoever has both gets the same ones.
+class EntityStore:
+    def __init__(self):
+        self.hp = defaultdict(int)  # Health points of the monster in each room
+        self.loot = defaultdict(int)  # Coins in each chest
+        self.traps = defaultdict(int)  # TRAP_* kind of each trap
+
+    def stock(self, data, seed):
+        rng = random.Random(seed + ENTITY_SALT)
+        for idx in room_indexes(data, RM_MNST):
+            self.hp[idx] = rng.randint(1, MONSTER_HP_MAX)
+        for idx in room_indexes(data, RM_CHEST):
+            self.loot[idx] = rng.randrange(TREASURE_MIN, TREASURE_MAX)
+        for idx in room_indexes(data, RM_TRAP):
+            self.traps[idx] = TRAP_GAS if rng.random() < GAS_CHANCE else TRAP_PIT
+
+    # The entities of the grid rooms, in grid order: one byte per monster, two per chest, one per trap
+    def pack(self, data):
+        loot = array("H", (self.loot[idx] for idx in room_indexes(data, RM_CHEST)))
+        if sys.byteorder == "little":
+            loot.byteswap()
+        return (bytes(self.hp[idx] for idx in room_indexes(data, RM_MNST)) + loot.tobytes() +
+                bytes(self.traps[idx] for idx in room_indexes(data, RM_TRAP)))
+
+    # Size of pack(data), from the grid alone
+    @staticmethod
+    def packed_size(data):
+        return data.count(ord(RM_MNST)) + 2 * data.count(ord(RM_CHEST)) + data.count(ord(RM_TRAP))
+
+    def unpack(self, data, buffer):
+        monsters = list(room_indexes(data, RM_MNST))
+        chests = list(room_indexes(data, RM_CHEST))
+        loot = array("H", bytes(buffer[len(monsters):len(monsters) + 2 * len(chests)]))
+        if sys.byteorder == "little":
+            loot.byteswap()
+
+        for idx, hp in zip(monsters, buffer[:len(monsters)]):
+            self.hp[idx] = hp
+        for idx, coins in zip(chests, loot):
+            self.loot[idx] = coins
+        for idx, kind in zip(room_indexes(data, RM_TRAP), buffer[len(monsters) + 2 * len(chests):]):
+            self.traps[idx] = kind
+
+
+# The rooms in sight from a room, up to DUNGEON_SIGHT away, by recursive shadowcasting. Each of the 8 octants around the
+# origin is scanned row by row moving away from it; a wall narrows the slopes still in sight for the rows past it,
+# splitting the scan in two around it. Cell offsets and slopes of every octant are computed once per radius and shared
+# by all the dungeons, so a scan only adds and compares. Fields are cached per origin room and dropped as soon as any
+# wall changes: a hit costs as much as the rooms in sight.
+class FieldOfView:
+    OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),  # (xx, xy, yx, yy) transforms
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+    TABLES = {}  # Radius -> octant tables, see tables()
+
+    def __init__(self, dungeon, radius=DUNGEON_SIGHT):
+        self.dungeon = dungeon
+        self.cache = OrderedDict()  # Origin -> positions in sight, least recently used first
+        self.octants = self.tables(radius)
+
+    # Per octant and row, nearest first: (x offset, y offset, left slope, right slope, within radius) of each cell
+    @classmethod
+    def tables(cls, radius):
+        octants = cls.TABLES.get(radius)
+        if octants is None:
+            octants = []
+            for xx, xy, yx, yy in cls.OCTANTS:
+                rows = []
+                for depth in range(1, radius + 1):
+                    dy = -depth
+                    rows.append(tuple((dx * xx + dy * xy, dx * yx + dy * yy, (dx - 0.5) / (dy + 0.5),
+                                       (dx + 0.5) / (dy - 0.5), dx * dx + dy * dy <= radius * radius)
+                                      for dx in range(-depth, 1)))
+                octants.append(tuple(rows))
+            octants = cls.TABLES[radius] = tuple(octants)
+        return octants
+
+    def invalidate(self):
+        self.cache.clear()
+
+    # Positions in sight from origin, origin included
+    def visible(self, origin):
+        seen = self.cache.get(origin)
+        if seen is not None:
+            self.cache.move_to_end(origin)
+            return seen
+
+        found = {origin}
+        for rows in self.octants:
+            self.cast(origin, rows, 0, 1.0, 0.0, found)
+        seen = self.cache[origin] = tuple(found)
+        if len(self.cache) > SIGHT_CACHED:
+            self.cache.popitem(last=False)
+        return seen
+
+    # Scan the rows of an octant from the given one, between the start and end slopes, adding what's in sight to found
+    def cast(self, origin, rows, first, start, end, found):
+        x, y = origin
+        get = self.dungeon.get
+        new_start = start
+        for row in range(first, len(rows)):
+            blocked = False
+            for ox, oy, left, right, inside in rows[row]:
+                if start < right:
+                    continue
+                if end > left:
+                    break
+
+                pos = x + ox, y + oy
+                room = get(pos)
+                if inside and room is not None:
+                    found.add(pos)
+                opaque = room == RM_WALL or room is None
+
+                if blocked:
+                    if opaque:
+                        new_start = right
+                    else:
+                        blocked = False
+                        start = new_start
+                elif opaque and row < len(rows) - 1:
+                    blocked = True
+                    self.cast(origin, rows, row + 1, start, left, found)
+                    new_start = right
+            if blocked:
+                break
 
 
 # Dungeon data
 class DungeonGraph:
-    data = []  # The actual grid
-    p1 = None  # Player 1 position
-    exit = None  # Exit position
-    p2 = None  # Player 2 position
-    ui_counter = 0  # Counter used to draw UI lines
-
-    def __init__(self, multi):
-        # Generate empty
-        for i in range(0, DUNGEON_SIZE):
-            self.data.append([])
-            for j in range(0, DUNGEON_SIZE):
-                self.data[i].append(RM_WALL)
+    # A dungeon is fully determined by multi, size, seed and players. A random seed is picked if none is given.
+    # With generate=False the grid is left full of walls, e.g. to be overwritten by a received map.
+    # Multiplayer dungeons have two players unless told otherwise. With more, their spawns are only in self.spawns
+    def __init__(self, multi, size=DUNGEON_SIZE, seed=None, generate=True, players=2, layout=None):
+        self.size = size  # Grid size per side
+        self.layout = layout or DUNGEON_LAYOUT  # Key of LAYOUTS
+        # The actual grid: one byte per room, row after row. Room (x, y) is at index x * size + y
+        self.data = bytearray(RM_WALL.encode()) * (size * size)
+        self.p1 = None  # Player 1 position
+        self.exit = None  # Exit position
+        self.p2 = None  # Player 2 position
+        self.others = []  # Positions of any further players, drawn like P2
+        self.spawns = []  # Starting position of every player
+        self.ui_counter = 0  # Counter used to draw UI lines
+        self.distances = DistanceField(self)  # Steps to the exit, computed on first use
+        self.entities = EntityStore()  # Stocked at the end of generation
+        self.sight = FieldOfView(self)  # Rooms in sight from each room, computed on first use
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)  # Generation only uses this, so the same seed gives the same map
+
+        if generate:
+            self.generate(multi, players)
+
+    # Smallest grid size with room for the given number of players, exit included, STUP_BLOCK rooms apart
+    @staticmethod
+    def min_size(players):
+        return math.ceil(math.sqrt(players + 1)) * STUP_BLOCK + 2
+
+    # Carve the layout, with players and exit, and fill the empty rooms. Each layout is a carve_* method taking multi,
+    # players and the budget of LAYOUT_BUDGET cells, and setting spawns, p1, p2 and exit. It returns True if all the
+    # players are sure to reach the exit; otherwise, e.g. when it ran out of budget, that's checked below.
+    # The budget counts cells, not seconds, so where the carving stops only depends on the seed and the size, and the
+    # same seed always gives the same map. It only bounds the carving: spawning, furnishing and the reachability check
+    # walk the whole grid after it, so they take longer as the grid grows whatever the budget.
+    def generate(self, multi, players=2):
+        if multi and players > 2 and self.size < self.min_size(players):
+            raise ValueError("%d players need a dungeon of size %d at least" % (players, self.min_size(players)))
+        connected = getattr(self, LAYOUTS[self.layout])(multi, players, LAYOUT_BUDGET)
+
+        self.furnish()
+
+        # Make sure every player can walk to the exit. Carving writes the grid directly, so start over afterwards.
+        # Dropping the distances first also spares updating them at every carved room.
+        unreachable = [] if connected else [pos for pos in self.spawns if not self.reachable(pos)]
+        if unreachable:
+            self.distances.invalidate()
+        for pos in unreachable:
+            self.connect_path(pos, self.exit)
+
+        self.entities.stock(self.data, self.seed)
+
+    # The original layout: corridors of drunken walks and straight lines between the players and the exit. Each walk
+    # and line is charged at its longest, DRUNK_LIMIT cells plus the distance between its ends.
+    def carve_drunk(self, multi, players, budget):
+        if multi and players > 2:
+            self.spawn_spaced(players)
+            for pos in self.spawns:
+                budget -= DRUNK_LIMIT + tpl_dst(pos, self.exit)
+                if budget < 0:
+                    break
+                self.drunken_star(pos, self.exit)
+        else:
+            self.spawn_pair(multi, budget)
+
+    # Rectangular rooms joined by corridors. The grid is split in two along its longer side, again and again until the
+    # blocks are at most ROOM_BLOCK long; each block gets a room, and the rooms of the two halves of every split are
+    # joined by an L-shaped corridor, so they're all connected unless the budget ran out before every block was done.
+    # Each block is charged its whole area.
+    def carve_rooms(self, multi, players, budget):
+        rng = self.rng
+        finished = [True]
+        left = [budget]
+
+        # Carve a room in the block from (x0, y0) to (x1, y1) excluded or split it, and return a room cell, or None
+        def split(x0, y0, x1, y1):
+            if left[0] < 0:
+                finished[0] = False
+                return None
+
+            height, width = x1 - x0, y1 - y0
+            if max(height, width) <= ROOM_BLOCK:  # Leave a wall on one side at least, between rooms of next blocks
+                left[0] -= height * width
+                room_h = rng.randint(min(ROOM_MIN, height - 1), height - 1)
+                room_w = rng.randint(min(ROOM_MIN, width - 1), width - 1)
+                rx, ry = rng.randint(x0, x1 - room_h), rng.randint(y0, y1 - room_w)
+                for x in range(rx, rx + room_h):
+                    self.data[x * self.size + ry:x * self.size + ry + room_w] = RM_EMPTY.encode() * room_w
+                return rng.randrange(rx, rx + room_h), rng.randrange(ry, ry + room_w)
+
+            if height >= width:
+                cut = rng.randint(x0 + ROOM_MIN + 1, x1 - ROOM_MIN - 1)
+                halves = split(x0, y0, cut, y1), split(cut, y0, x1, y1)
+            else:
+                cut = rng.randint(y0 + ROOM_MIN + 1, y1 - ROOM_MIN - 1)
+                halves = split(x0, y0, x1, cut), split(x0, cut, x1, y1)
+
+            if None in halves:
+                return halves[0] or halves[1]
+            self.carve_corridor(*halves)
+            return halves[rng.getrandbits(1)]
+
+        split(1, 1, self.size - 1, self.size - 1)
+        return self.spawn_apart(multi, players) and finished[0]
+
+    # Natural caves. Cells start as walls or empty at random, then CAVE_STEPS smoothing passes make a wall of the cells
+    # with at least 5 walls among the 9 around and including them. The grid is a bitboard, a big int with bit
+    # x * size + y set for walls, so a pass is a few dozen operations on whole ints: neighbour counts are summed one
+    # bit plane at a time, like a binary adder. That's about 1/16 of the time per cell of the other layouts, so a pass
+    # is charged size * size // 16 cells.
+    def carve_caves(self, multi, players, budget):
+        size = self.size
+        cells = size * size
+        full = (1 << cells) - 1
+        border = 0
+        for x in range(size):
+            border |= 1 << x * size | 1 << x * size + size - 1
+        border |= (1 << size) - 1 | ((1 << size) - 1) << cells - size
+
+        walls = self.rng.getrandbits(cells) | border
+        for _ in range(CAVE_STEPS):
+            budget -= cells // 16
+            if budget < 0:
+                break
 
-        random.seed()
+            # Count bits 0 to 3 of the walls among the 9 cells around each one. Shifts by one row are by size bits:
+            # what wraps across a row side or falls off the grid only touches border cells, which are reset after
+            counter = [0, 0, 0, 0]
+            for rows in (walls, walls << size, walls >> size):
+                for board in (rows, rows << 1, rows >> 1):
+                    carry = board & full
+                    for bit in range(4):
+                        counter[bit], carry = counter[bit] ^ carry, counter[bit] & carry
+
+            # 5 or more: 8 (bit 3), or 4 (bit 2) with 1 or 2 on top
+            walls = counter[3] | counter[2] & (counter[1] | counter[0]) | border
+
+        # Back to one byte per room: each byte of the bitboard becomes 8 rooms
+        rooms = [bytes(ord(RM_WALL) if bits >> k & 1 else ord(RM_EMPTY) for k in range(8)) for bits in range(256)]
+        self.data[:] = b"".join(map(rooms.__getitem__, walls.to_bytes((cells + 7) // 8, "little")))[:cells]
+        self.spawn_apart(multi, players)
+
+    # Empty the cells of an L-shaped corridor from start to goal, first along the row of start then along the column of
+    # goal. The exit is never run over.
+    def carve_corridor(self, start, goal):
+        (sx, sy), (gx, gy) = start, goal
+        size, data = self.size, self.data
+        exit_idx = None if self.exit is None else self.exit[0] * size + self.exit[1]
+        row = range(sx * size + min(sy, gy), sx * size + max(sy, gy) + 1)
+        column = range(min(sx, gx) * size + gy, max(sx, gx) * size + gy + 1, size)
+        for idx in itertools.chain(row, column):
+            if idx != exit_idx:
+                data[idx] = ord(RM_EMPTY)
+
+    # Spawn the exit and the players on empty cells, away from each other: each in turn goes on the cell farthest from
+    # those already taken out of a few random ones. On an almost empty grid, they're spaced by spawn_spaced instead.
+    # Returns whether they're on carved cells.
+    def spawn_apart(self, multi, players):
+        count = (players if multi else 1) + 1
+        empties = self.get_empty()
+        carved = len(empties) >= count
+        if not carved:
+            self.spawn_spaced(count - 1)
+        else:
+            taken = [self.rng.choice(empties)]
+            while len(taken) < count:
+                candidates = self.rng.sample(empties, min(len(empties), STUP_TOL * 4))
+                farthest = max(candidates, key=lambda idx: min(
+                    tpl_dst(divmod(idx, self.size), divmod(other, self.size)) for other in taken))
+                if farthest in taken:  # Every candidate was taken already: no two go on the same cell
+                    farthest = next(idx for idx in empties if idx not in taken)
+                taken.append(farthest)
+
+            self.exit, *self.spawns = (divmod(idx, self.size) for idx in taken)
+            self.set(self.exit, RM_EXIT)
+
+        self.p1 = self.spawns[0]
+        self.p2 = self.spawns[1] if multi else None
+        if not multi:
+            self.spawns = self.spawns[:1]
+        return carved
+
+    # Spawn P1, the exit and P2 in multiplayer, away from each other, and connect them
+    def spawn_pair(self, multi, budget):
+        size = self.size
+        rng = self.rng
 
         # Spawn random P1
-        self.p1 = random_coord()
+        self.p1 = random_coord(rng, size)
         self.set(self.p1, RM_EMPTY)  # Player cell is freed. Player symbol is drawn with print functions
 
         min_dst = STUP_DST
@@ -78,7 +599,7 @@ class DungeonGraph:
 
         # Spawn random exit distant at least min_dst
         while True:
-            self.exit = random_coord()
+            self.exit = random_coord(rng, size)
             if tpl_dst(self.p1, self.exit) > min_dst:
                 self.set(self.exit, RM_EXIT)
                 break
@@ -94,7 +615,7 @@ class DungeonGraph:
         # On multiplayer mode, spawn random P2
         if multi:
             while True:
-                self.p2 = random_coord()
+                self.p2 = random_coord(rng, size)
                 if tpl_dst(self.p1, self.p2) > min_dst and tpl_dst(self.exit, self.p2) > min_dst:
                     self.set(self.p2, RM_EMPTY)
                     break
@@ -107,10 +628,43 @@ class DungeonGraph:
         # Connect P1 and exit through drunken star method
         self.drunken_star(self.p1, self.exit)
 
-        if multi:  # Do the same to connect P1-P2 and exit-P2 on multiplayer
+        # Do the same to connect P1-P2 and exit-P2 on multiplayer, if the budget covers the three walks, charged as
+        # in carve_drunk
+        if multi:
+            budget -= 3 * DRUNK_LIMIT + tpl_dst(self.p1, self.exit)
+            budget -= tpl_dst(self.p2, self.p1) + tpl_dst(self.p2, self.exit)
+        if multi and budget >= 0:
             self.drunken_star(self.p1, self.p2)
             self.drunken_star(self.exit, self.p2)
 
+        self.spawns = [pos for pos in (self.p1, self.p2) if pos is not None]
+
+    # Spawn the exit and the given number of players in one pass. The grid is split in a lattice of at least
+    # players + 1 blocks, and each of them goes in the middle half of a different block, so they're kept apart
+    # by about half a block at least. Blocks are STUP_BLOCK rooms long at least on grids of min_size or more.
+    def spawn_spaced(self, players):
+        side = math.ceil(math.sqrt(players + 1))
+        block = (self.size - 2) / side
+
+        coords = []
+        for cell in self.rng.sample(range(side * side), players + 1):
+            coord = []
+            for lattice in divmod(cell, side):
+                lo, hi = 1 + int(lattice * block), 1 + int((lattice + 1) * block)
+                margin = (hi - lo) // 4
+                coord.append(self.rng.randrange(lo + margin, max(hi - margin, lo + margin + 1)))
+            coords.append(tuple(coord))
+
+        self.exit = coords.pop()
+        self.set(self.exit, RM_EXIT)
+        for pos in coords:
+            self.set(pos, RM_EMPTY)
+        self.spawns = coords
+        self.p1, self.p2 = coords[0], coords[1] if players > 1 else None
+
+    # Fill the empty rooms with monsters, traps, quizzes, chests and items
+    def furnish(self):
+        rng = self.rng
         empties = self.get_empty()
         empties_len = len(empties)
 
@@ -120,52 +674,76 @@ class DungeonGraph:
         quiz_count = int(empties_len * PC_QUIZ)
         chest_count = int(empties_len * PC_CHEST)
 
-        knives_count = random.randint(1, 2)
-        swords_count = random.randint(1, 2)
+        knives_count = rng.randint(1, 2)
+        swords_count = rng.randint(1, 2)
 
         symbols = (RM_MNST, RM_TRAP, RM_QUIZ, RM_CHEST, RM_KNIFE, RM_SWRD, RM_COMP, RM_LOCKP)
         counts = (mnst_count, trap_count, quiz_count, chest_count, knives_count, swords_count, 1, 2)
 
         # For each couple of symbols and amounts, fill random empty cells
-        for s, c in [(symbols[i], counts[i]) for i in range(0, 8)]:
-            self.place(s, c, empties)
+        self.place(zip(symbols, counts), empties)
 
     # Places a certain room_type within the given pos tuple
     def set(self, pos, room_type):
-        self.data[pos[0]][pos[1]] = room_type
+        idx = pos[0] * self.size + pos[1]
+        old, new = self.data[idx], ord(room_type)
+        self.data[idx] = new
+        if old != new:
+            self.distances.room_changed(idx, old, new)
+            if ord(RM_WALL) in (old, new):
+                self.sight.invalidate()
+
+    # The EntityStore and index holding what's in the room at pos
+    def entity(self, pos):
+        return self.entities, pos[0] * self.size + pos[1]
 
     # Retrieves the room at the given pos tuple, or None if out of bounds
     def get(self, pos):
         x, y = pos
-        if 0 <= x < DUNGEON_SIZE and 0 <= y < DUNGEON_SIZE:
-            return self.data[pos[0]][pos[1]]
+        if 0 <= x < self.size and 0 <= y < self.size:
+            return ROOM_CHARS[self.data[x * self.size + y]]
         else:
             return None
 
+    # Get row x of the grid as raw bytes, one per room
+    def get_row(self, x):
+        return bytes(self.data[x * self.size:(x + 1) * self.size])
+
+    # Steps from pos to the nearest exit, or None if the exit can't be reached from there
+    def distance(self, pos):
+        dist = self.distances.get(pos[0] * self.size + pos[1])
+        return None if dist == DistanceField.UNREACHABLE else dist
+
+    def reachable(self, pos):
+        return self.distance(pos) is not None
+
     # Returns the array of north, south, east and west tuple, given they're within bounds
     def get_nearby(self, pos):
         nearby = []
         x, y = pos
         if x > 0:
             nearby.append((x - 1, y))
-        if x < DUNGEON_SIZE - 1:
+        if x < self.size - 1:
             nearby.append((x + 1, y))
         if y > 0:
             nearby.append((x, y - 1))
-        if y < DUNGEON_SIZE - 1:
+        if y < self.size - 1:
             nearby.append((x, y + 1))
         return nearby
 
     # Print the whole map
     def print(self):
-        print(" " + "--- " * DUNGEON_SIZE)  # Top rule
-        for i in range(0, DUNGEON_SIZE):
-            for j in range(0, DUNGEON_SIZE):
-                # If the (i, j) couple matches P1 or P2 print the Player symbol instead
-                symbol = RM_PLAYER if (i, j) == self.p1 else RM_PLAYER2 if (i, j) == self.p2 else self.get((i, j))
-                print("| " + symbol + " ", end="", flush=True)
-            print("|")  # Termination bar
-            print(" " + "--- " * DUNGEON_SIZE)  # Bottom rule
+        rows = []
+        for i in range(0, self.size):
+            row = list(self.get_row(i).decode())
+            # If the (i, j) couple matches a player print the Player symbol instead
+            players = [(pos, RM_PLAYER2) for pos in self.others] + [(self.p2, RM_PLAYER2), (self.p1, RM_PLAYER)]
+            for pos, symbol in players:
+                if pos is not None and pos[0] == i:
+                    row[pos[1]] = symbol
+            rows.append((row, ""))
+
+        renderer.draw(rows)
 
     # Print the UI, given current player position, radius of sight and player info
     def print_hidden(self, pos, radius, player_info):
@@ -174,40 +752,36 @@ class DungeonGraph:
         # Adjust "camera" center if near sides
         if x < radius:
             x = radius
-        elif x > DUNGEON_SIZE - radius:
-            x = DUNGEON_SIZE - radius
+        elif x > self.size - radius:
+            x = self.size - radius
 
         if y < radius:
             y = radius
-        elif y > DUNGEON_SIZE - radius:
-            y = DUNGEON_SIZE - radius
+        elif y > self.size - radius:
+            y = self.size - radius
 
         submatrix = []
+        y_lo, y_hi = max(y - radius, 0), min(y + radius, self.size)
 
-        # Extract submatrix of nearby cells as (x, y) tuples
-        for i in range(0, DUNGEON_SIZE):
-            if x - radius <= i < x + radius:
-                subrow = []
-                # Extract elements of subrow i
-                for j in range(0, DUNGEON_SIZE):
-                    if y - radius <= j < y + radius:
-                        # Hide elements unknown to the player; substitute player position symbol with RM_PLAYER
-                        subrow.append(RM_PLAYER if (i, j) == self.p1
-                                      else RM_PLAYER2 if (i, j) == self.p2 and (i, j) in player_info.discovered
-                                      else self.data[i][j] if (i, j) in player_info.discovered
-                                      else RM_UNKNW)
+        # Extract submatrix of nearby cells, slicing only the rows and columns within sight
+        for i in range(max(x - radius, 0), min(x + radius, self.size)):
+            rooms = self.data[i * self.size + y_lo:i * self.size + y_hi].decode()
+            fog = player_info.fog_row(i, y_lo, y_hi)
 
-                submatrix.append(subrow)
+            # Hide elements unknown to the player
+            subrow = [rooms[k] if fog >> k & 1 else RM_UNKNW for k in range(y_hi - y_lo)]
 
-        size = len(submatrix)
+            # Substitute player position symbol with RM_PLAYER, and the other players ones if discovered
+            for pos in self.others + [self.p2]:
+                if pos is not None and pos[0] == i and y_lo <= pos[1] < y_hi and fog >> pos[1] - y_lo & 1:
+                    subrow[pos[1] - y_lo] = RM_PLAYER2
+            if self.p1 is not None and self.p1[0] == i and y_lo <= self.p1[1] < y_hi:
+                subrow[self.p1[1] - y_lo] = RM_PLAYER
+
+            submatrix.append(subrow)
 
         # Print the submatrix. Similar to print() method
-        print(" " + "--- " * size)
-        for i in range(0, size):
-            for j in range(0, size):
-                print("| " + submatrix[i][j] + " ", end="", flush=True)
-            print("|" + self.get_ui_line(player_info))
-            print(" " + "--- " * size)
+        renderer.draw([(subrow, self.get_ui_line(player_info)) for subrow in submatrix])
 
         self.ui_counter = 0
 
@@ -234,50 +808,39 @@ class DungeonGraph:
         else:
             return ""
 
-    # Trace a Drunken Walk (choose a random direction) from start up to a limit number of cells
+    # Trace a Drunken Walk (choose a random direction) from start up to a limit number of cells.
+    # Each step keeps the last direction by CORRIDOR_BIAS, or turns to one of the other three by CORRIDOR_CM_BIAS.
+    # Steps are drawn limit at a time and the walk gives up after limit * DRUNK_ATTEMPTS of them, out of bounds and
+    # blocked ones included, so it always ends in bounded time.
     def drunk_path(self, start, limit):
-        drunk_count = 0
-        pos = start
-        dirs = [(0, 1), (-1, 0), (0, -1), (1, 0)]  # East, South, West, North. Remember it's (row, column)
-        most_likely = (0, 1)
+        size = self.size
+        data = self.data
+        wall, empty, exit_room = ord(RM_WALL), ord(RM_EMPTY), ord(RM_EXIT)
+        x, y = start
+        heading = 0  # Index in WALK_DIRS of the most likely direction
+        batch = max(int(limit), 1)
         seq = []
 
-        while True:
-            # Swap most likely direction to first index
-            idx = dirs.index(most_likely)
-            dirs[0], dirs[idx] = dirs[idx], dirs[0]
-            rnd = random.random()
-
-            # Pick a random direction, favoring the first one
-            if rnd < CORRIDOR_BIAS:
-                cur_dir = dirs[0]
-            elif rnd < CORRIDOR_BIAS + CORRIDOR_CM_BIAS:
-                cur_dir = dirs[1]
-            elif rnd < CORRIDOR_BIAS + 2 * CORRIDOR_CM_BIAS:
-                cur_dir = dirs[2]
-            else:
-                cur_dir = dirs[3]
-
-            next_pos = pos[0] + cur_dir[0], pos[1] + cur_dir[1]
-
-            # If chosen cell is valid (is within [0, 0]x[DUNGEON_SIZE - 1, DUNGEON_SIZE - 1])...
-            if before((0, 0), next_pos) and before(next_pos, (DUNGEON_SIZE - 1, DUNGEON_SIZE - 1)):
-                next_tile = self.get(next_pos)
-
-                if next_tile == RM_EXIT:  # Stop if you reach the exit
-                    break
-                elif next_tile == RM_EMPTY or next_tile == RM_WALL:  # Else if wall or empty...
-                    self.set(next_pos, RM_EMPTY)  # Free this tile
-                    seq.append(next_pos)  # Add next position to sequence
-                    pos = next_pos  # Update position
-                    most_likely = cur_dir  # Update most likely direction
-                    drunk_count += 1  # Step  counter
-                    if drunk_count >= limit:
-                        break  # Stop if reached the limit
-                else:
-                    continue
-            else:
-                continue  # Out of bounds, try again
+        for _ in range(DRUNK_ATTEMPTS):
+            # Turns relative to the heading: 0 goes straight, 1 to 3 pick one of the other directions
+            for turn in self.rng.choices(range(4), cum_weights=WALK_WEIGHTS, k=batch):
+                direction = (heading + turn) & 3
+                nx, ny = x + WALK_DIRS[direction][0], y + WALK_DIRS[direction][1]
+
+                # If chosen cell is valid (is within [0, 0]x[size - 1, size - 1])...
+                if 0 < nx < size - 1 and 0 < ny < size - 1:
+                    idx = nx * size + ny
+                    room = data[idx]
+
+                    if room == exit_room:  # Stop if you reach the exit
+                        return seq
+                    elif room == empty or room == wall:  # Else if wall or empty...
+                        data[idx] = empty  # Free this tile
+                        seq.append((nx, ny))
+                        x, y = nx, ny
+                        heading = direction
+                        if len(seq) >= limit:
+                            return seq  # Stop if reached the limit
 
         return seq
 
@@ -302,56 +865,95 @@ class DungeonGraph:
             if current == goal:
                 break
 
-            self.set(current, RM_EMPTY)     # Empty the current cell
+            if self.get(current) == RM_WALL:    # Empty the current cell, without running over the exit
+                self.set(current, RM_EMPTY)
 
-            if random.random() < DRUNK_CHANCE:  # By DRUNK_CHANCE, do a Drunken Walk from the current cell
+            if self.rng.random() < DRUNK_CHANCE:  # By DRUNK_CHANCE, do a Drunken Walk from the current cell
                 self.drunk_path(current, DRUNK_LIMIT / 10)
 
     # Use drunken walk + connect_path to connect start and goal
     def drunken_star(self, start, goal):
         dr_path = self.drunk_path(start, DRUNK_LIMIT)   # Do a random walk from start
-        connect_start = random.choice(dr_path)    # Connect goal to a random position in the path
+        # Connect goal to a random position in the path, or to start if the walk got stuck right away
+        connect_start = self.rng.choice(dr_path) if dr_path else start
         self.connect_path(connect_start, goal)
 
-    # Get all empty cells as (x, y) tuples. Exclude player cells.
+    # Get all empty cells as grid indexes (x * size + y). Exclude player cells.
     def get_empty(self):
-        return [(i, j) for i in range(DUNGEON_SIZE) for j in range(DUNGEON_SIZE) if
-                self.data[i][j] == RM_EMPTY and (i, j) not in (self.p1, self.p2)]
+        empty = ord(RM_EMPTY)
 
-    # Place count times symbol over the grid, given the list of empty cells
-    def place(self, symbol, count, empties):
-        placed = 0
-        while placed < count:
-            x, y = random.choice(empties)
-            self.data[x][y] = symbol
-            empties.remove((x, y))
-            placed += 1
+        if self.data.count(empty) * 16 > len(self.data):
+            # Mostly open grid: compare every byte, all at C speed
+            empties = list(itertools.compress(range(len(self.data)), map(empty.__eq__, self.data)))
+        else:
+            # Mostly walls: let bytearray.find skip them
+            empties = []
+            idx = self.data.find(empty)
+            while idx != -1:
+                empties.append(idx)
+                idx = self.data.find(empty, idx + 1)
+
+        taken = {pos[0] * self.size + pos[1] for pos in self.spawns + [self.p1, self.p2] if pos is not None}
+        if taken:
+            empties = [idx for idx in empties if idx not in taken]
+        return empties
+
+    # Place each (symbol, count) couple over the grid, given the list of empty cell indexes. All the cells are sampled
+    # at once, without replacement, then handed out to the symbols in order. Stops early if there aren't enough cells.
+    def place(self, placements, empties):
+        placements = list(placements)
+        total = min(sum(count for _, count in placements), len(empties))
+        picked = iter(self.rng.sample(empties, total))
+
+        for symbol, count in placements:
+            room = ord(symbol)
+            for idx in itertools.islice(picked, count):
+                self.data[idx] = room
 
 
 # Player data
 class Player:
-    name = "???"
+    __slots__ = ("size", "discovered", "name", "health", "coin", "has_lockpick", "has_knife", "has_sword",
+                 "has_compass")
     HP_MAX = 10
     COIN_MAX = 9999
-    health = 10
-    coin = 10
-    discovered = set([])
-    has_lockpick = False
-    has_knife = False
-    has_sword = False
-    has_compass = False
+
+    def __init__(self, size=DUNGEON_SIZE):
+        self.size = size  # Size per side of the dungeon being explored
+        # Fog of war: one bit per room, aligned with the dungeon grid. Bit (x * size + y) is set if (x, y) is discovered
+        self.discovered = bytearray((size * size + 7) // 8)
+        self.name = "???"
+        self.health = 10
+        self.coin = 10
+        self.has_lockpick = False
+        self.has_knife = False
+        self.has_sword = False
+        self.has_compass = False
 
     def attacked(self, health_lost):
         self.health = self.health - health_lost if self.health > health_lost else 0
         return self.health != 0
 
+    # Mark the given (x, y) positions as discovered
     def discover(self, new):
-        self.discovered |= new
+        for x, y in new:
+            idx = x * self.size + y
+            self.discovered[idx >> 3] |= 1 << (idx & 7)
+
+    def is_discovered(self, pos):
+        idx = pos[0] * self.size + pos[1]
+        return self.discovered[idx >> 3] >> (idx & 7) & 1 == 1
+
+    # Fog bits of row x between columns y_lo and y_hi as an int: bit k is set if (x, y_lo + k) is discovered
+    def fog_row(self, x, y_lo, y_hi):
+        start = x * self.size + y_lo
+        end = x * self.size + y_hi
+        return int.from_bytes(self.discovered[start >> 3:(end + 7) >> 3], "little") >> (start & 7)
 
 
-# Get a random coordinate except borders.
-def random_coord():
-    return random.randint(1, DUNGEON_SIZE - 2), random.randint(1, DUNGEON_SIZE - 2)
+# Get a random coordinate except borders, drawn from the given random.Random
+def random_coord(rng, size=DUNGEON_SIZE):
+    return rng.randint(1, size - 2), rng.randint(1, size - 2)
 
 
 # Distance between coordinates is defined by taxicab-geometry rather then euclidean
@@ -361,105 +963,1587 @@ def tpl_dst(a, b):
     return abs(x1 - x2) + abs(y1 - y2)
 
 
-def before(ta, tb):
-    return ta[0] < tb[0] and ta[1] < tb[1]
+#####################################################################################################################
+#       ENDLESS DUNGEON                                                                                             #
+#####################################################################################################################
+#   An unbounded map split in ENDLESS_CHUNK square chunks, generated when first looked at. Each chunk is a small    #
+#   DungeonGraph: a hub room joined by drunken walks to the gates on its four borders, then furnished like a whole  #
+#   dungeon. Gates are drawn from the seed of the border itself, so both chunks sharing it open the same rooms and  #
+#   the corridors go on across it. Chunks are seeded from the dungeon seed and their coordinates, so one dropped    #
+#   from the cache comes back the same, together with the rooms the player changed there (cleared monsters, taken   #
+#   items...). Those changes are kept for the last ENDLESS_EDITED chunks changed, so memory stays bounded however   #
+#   long the walk: past them a chunk comes back as it was generated. What the player discovered there is forgotten. #
+#   Single player only: positions are unbounded and there is no grid to send.                                       #
+#####################################################################################################################
+
+class EndlessDungeon:
+    def __init__(self, seed=None):
+        self.size = ENDLESS_CHUNK  # Per chunk: the dungeon itself has no bounds
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.chunks = OrderedDict()  # (cx, cy) -> [chunk DungeonGraph, fog bytearray], least recently used first
+        self.edits = OrderedDict()  # (cx, cy) -> {chunk grid index: room byte}, least recently changed chunk first
+        self.p2 = None
+        self.ui_counter = 0
+        self.sight = FieldOfView(self)
+
+        rng = random.Random(self.seed)
+        cx = rng.randint(-ENDLESS_EXIT_CHUNKS, ENDLESS_EXIT_CHUNKS)
+        cy = rng.choice((-1, 1)) * (ENDLESS_EXIT_CHUNKS - abs(cx))
+        self.exit_chunk = cx, cy
+        self.p1 = self.world(0, 0, self.hub(0, 0))
+        self.exit = self.world(cx, cy, self.hub(cx, cy))
+
+    # Same string seeds give the same numbers on every platform and Python version
+    def derived_rng(self, *key):
+        return random.Random("/".join(map(str, (self.seed,) + key)))
+
+    # Chunk coordinates of a world position, and the position within the chunk
+    @staticmethod
+    def split(pos):
+        (cx, x), (cy, y) = divmod(pos[0], ENDLESS_CHUNK), divmod(pos[1], ENDLESS_CHUNK)
+        return (cx, cy), (x, y)
+
+    @staticmethod
+    def world(cx, cy, pos):
+        return cx * ENDLESS_CHUNK + pos[0], cy * ENDLESS_CHUNK + pos[1]
+
+    def hub(self, cx, cy):
+        return random_coord(self.derived_rng(cx, cy, "hub"), ENDLESS_CHUNK)
+
+    # Border columns (or rows) open between chunk (cx, cy) and the one below it (axis "x") or to its right ("y")
+    def gate_lines(self, cx, cy, axis):
+        rng = self.derived_rng(cx, cy, axis)
+        return rng.sample(range(1, ENDLESS_CHUNK - 1), rng.randint(1, 2))
+
+    # All the gate rooms of chunk (cx, cy), as positions within the chunk
+    def gates(self, cx, cy):
+        last = ENDLESS_CHUNK - 1
+        return [(last, g) for g in self.gate_lines(cx, cy, "x")] + \
+            [(0, g) for g in self.gate_lines(cx - 1, cy, "x")] + \
+            [(g, last) for g in self.gate_lines(cx, cy, "y")] + \
+            [(g, 0) for g in self.gate_lines(cx, cy - 1, "y")]
+
+    def generate_chunk(self, cx, cy):
+        chunk = DungeonGraph(False, ENDLESS_CHUNK, self.derived_rng(cx, cy).getrandbits(64), generate=False)
+        hub = self.hub(cx, cy)
+        chunk.set(hub, RM_EMPTY)
+
+        # One drunken star like in a whole dungeon, straight lines (with their side walks) to the other gates
+        gates = self.gates(cx, cy)
+        for gate in gates:
+            chunk.set(gate, RM_EMPTY)
+        chunk.drunken_star(hub, gates[0])
+        for gate in gates[1:]:
+            chunk.connect_path(hub, gate)
+
+        if (cx, cy) == self.exit_chunk:
+            chunk.set(hub, RM_EXIT)
+        elif (cx, cy) == (0, 0):
+            chunk.p1 = hub  # Keep the starting room free
+
+        chunk.furnish()
+        for idx, room in self.edits.get((cx, cy), {}).items():
+            chunk.data[idx] = room
+        chunk.entities.stock(chunk.data, chunk.seed)
+        return chunk
+
+    # The [chunk, fog] record of chunk (cx, cy), generating it if needed and dropping the least recently used one
+    def load(self, key):
+        record = self.chunks.get(key)
+        if record is None:
+            record = [self.generate_chunk(*key), bytearray((ENDLESS_CHUNK * ENDLESS_CHUNK + 7) // 8)]
+            self.chunks[key] = record
+            if len(self.chunks) > ENDLESS_CACHED:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(key)
+        return record
+
+    def set(self, pos, room_type):
+        key, local = self.split(pos)
+        if RM_WALL in (room_type, self.get(pos)):
+            self.sight.invalidate()
+        self.load(key)[0].set(local, room_type)
+        self.edits.setdefault(key, {})[local[0] * ENDLESS_CHUNK + local[1]] = ord(room_type)
+        self.edits.move_to_end(key)
+        if len(self.edits) > ENDLESS_EDITED:
+            self.edits.popitem(last=False)
+
+    def get(self, pos):
+        key, local = self.split(pos)
+        return self.load(key)[0].get(local)
+
+    # Entities live in the chunks: a hurt monster is back to full health if its chunk is dropped from the cache
+    def entity(self, pos):
+        key, local = self.split(pos)
+        return self.load(key)[0].entity(local)
+
+    # Rooms of row x between columns y_lo and y_hi, as a string
+    def get_span(self, x, y_lo, y_hi):
+        span = []
+        while y_lo < y_hi:
+            (cx, cy), (lx, ly) = self.split((x, y_lo))
+            stop = min(y_hi - y_lo, ENDLESS_CHUNK - ly)
+            start = lx * ENDLESS_CHUNK + ly
+            span.append(self.load((cx, cy))[0].data[start:start + stop].decode())
+            y_lo += stop
+        return "".join(span)
+
+    # Only known within a chunk: the compass shows the direction alone
+    def distance(self, pos):
+        return None
+
+    def reachable(self, pos):
+        return True  # Every chunk is joined to all four of its neighbours
+
+    def get_nearby(self, pos):
+        x, y = pos
+        return [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]
+
+    # Print the chunks around P1
+    def print(self):
+        (cx, cy), _ = self.split(self.p1)
+        x_lo, y_lo = self.world(cx - 1, cy - 1, (0, 0))
+        rows = []
+        for x in range(x_lo, x_lo + 3 * ENDLESS_CHUNK):
+            row = list(self.get_span(x, y_lo, y_lo + 3 * ENDLESS_CHUNK))
+            if self.p1[0] == x:
+                row[self.p1[1] - y_lo] = RM_PLAYER
+            rows.append((row, ""))
+        renderer.draw(rows)
+
+    # Same as DungeonGraph.print_hidden, without any side to keep the camera away from
+    def print_hidden(self, pos, radius, player_info):
+        x, y = pos
+        y_lo, y_hi = y - radius, y + radius
+        submatrix = []
+
+        for i in range(x - radius, x + radius):
+            rooms = self.get_span(i, y_lo, y_hi)
+            fog = player_info.fog_row(i, y_lo, y_hi)
+            subrow = [rooms[k] if fog >> k & 1 else RM_UNKNW for k in range(y_hi - y_lo)]
+            if self.p1[0] == i:
+                subrow[self.p1[1] - y_lo] = RM_PLAYER
+            submatrix.append(subrow)
+
+        renderer.draw([(subrow, self.get_ui_line(player_info)) for subrow in submatrix])
+        self.ui_counter = 0
+
+    get_ui_line = DungeonGraph.get_ui_line
+
+
+# Player of an endless dungeon. The fog of war is kept per chunk, next to the chunk itself
+class EndlessPlayer(Player):
+    __slots__ = ("dungeon",)
+
+    def __init__(self, dungeon):
+        super().__init__(0)
+        self.dungeon = dungeon
+
+    def discover(self, new):
+        for pos in new:
+            key, (x, y) = self.dungeon.split(pos)
+            idx = x * ENDLESS_CHUNK + y
+            self.dungeon.load(key)[1][idx >> 3] |= 1 << (idx & 7)
+
+    def is_discovered(self, pos):
+        key, (x, y) = self.dungeon.split(pos)
+        idx = x * ENDLESS_CHUNK + y
+        return self.dungeon.load(key)[1][idx >> 3] >> (idx & 7) & 1 == 1
+
+    def fog_row(self, x, y_lo, y_hi):
+        fog = 0
+        for k in range(y_hi - y_lo):
+            if self.is_discovered((x, y_lo + k)):
+                fog |= 1 << k
+        return fog
+
+
+#####################################################################################################################
+#       DUNGEON POOL                                                                                                #
+#####################################################################################################################
+#   Dungeons generated ahead of time, in POOL_WORKERS background processes, so a game doesn't wait for its own.     #
+#   Up to POOL_DEPTH are kept ready for each (multi, size, players, layout) asked for: take() hands one out right   #
+#   away, or None if there's none yet, and orders another without waiting for it. Seeds are drawn here, since       #
+#   forked workers would all draw the same ones.                                                                    #
+#####################################################################################################################
+
+POOL_DEPTH = 2  # Dungeons kept ready per configuration
+POOL_WORKERS = 2  # Background processes generating them
+
+
+# Runs in a pool worker
+def pool_generate(multi, size, seed, players, layout):
+    return DungeonGraph(multi, size, seed, players=players, layout=layout)
+
+
+class DungeonPool:
+    def __init__(self, depth=POOL_DEPTH, workers=POOL_WORKERS):
+        self.depth = depth
+        self.workers = workers
+        self.executor = None  # Started on first use
+        self.ready = {}  # Configuration -> deque of dungeons
+        self.pending = {}  # Configuration -> dungeons being generated
+        self.lock = threading.Lock()  # Futures complete on the executor thread
+
+    # Order dungeons of a configuration up to the pool depth, without waiting for them
+    def warm(self, multi, size=DUNGEON_SIZE, players=2):
+        self.refill((multi, size, players, DUNGEON_LAYOUT))
+
+    # A ready dungeon of the given configuration, or None if there's none yet
+    def take(self, multi, size=DUNGEON_SIZE, players=2):
+        key = (multi, size, players, DUNGEON_LAYOUT)
+        with self.lock:
+            ready = self.ready.get(key)
+            dungeon = ready.popleft() if ready else None
+        self.refill(key)
+        return dungeon
+
+    def refill(self, key):
+        with self.lock:
+            missing = self.depth - len(self.ready.setdefault(key, deque())) - self.pending.get(key, 0)
+            if missing <= 0:
+                return
+            self.pending[key] = self.pending.get(key, 0) + missing
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+
+        multi, size, players, layout = key
+        for _ in range(missing):
+            try:
+                future = self.executor.submit(pool_generate, multi, size, random.getrandbits(32), players, layout)
+            except RuntimeError:  # Shut down
+                return
+            future.add_done_callback(functools.partial(self.done, key))
+
+    def done(self, key, future):
+        with self.lock:
+            self.pending[key] -= 1
+            if future.cancelled() or future.exception() is not None:
+                return
+            self.ready[key].append(future.result())
+
+    # Drop the orders not started yet and stop the workers, once they're done with the dungeons they're generating
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
 
 
-# Discover nearby rooms and print the hidden map
-def update(curr_tile, player, dungeon):
-    new_room = dungeon.get(curr_tile)
+dungeons = DungeonPool()  # Shared by every game of this process
 
-    # Add nearby rooms to discovered if Wall, Empty or Exit, plus current cell in any case
-    newly_discovered = set([near_pos for near_pos in dungeon.get_nearby(curr_tile) if
-                            dungeon.get(near_pos) in (RM_WALL, RM_EXIT, RM_EMPTY)] + [curr_tile])
+
+#####################################################################################################################
+#       QUIZ BANK                                                                                                   #
+#####################################################################################################################
+#   One quiz per line, as question-answer. The answer follows the last '-', so questions may contain hyphens. The   #
+#   file is memory mapped and only the offsets of its lines are kept, so a quiz is read and decoded when drawn.     #
+#   GameState draws them through a lazy Fisher-Yates shuffle: no repeats until the bank runs out, in O(1) each.     #
+#####################################################################################################################
+
+# Lowercase, with single spaces. Applied to answers when a quiz is loaded and to what the player types
+def normalize_answer(text):
+    return " ".join(text.split()).lower()
+
+
+class QuizBank:
+    def __init__(self, path):
+        self.offsets = array('Q')  # Start and end of each valid line, one after the other
+        self.data = b""
+
+        with open(path, "rb") as quiz_file:
+            if os.fstat(quiz_file.fileno()).st_size > 0:
+                self.data = mmap.mmap(quiz_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start, end = 0, len(self.data)
+        while start < end:
+            stop = self.data.find(b"\n", start)
+            if stop < 0:
+                stop = end
+            if self.data.find(b"-", start, stop) >= 0:  # Skip blank or malformed lines
+                self.offsets.extend((start, stop))
+            start = stop + 1
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    # (question, answer) couple, with the answer already normalized
+    def __getitem__(self, index):
+        line = self.data[self.offsets[2 * index]:self.offsets[2 * index + 1]].decode("utf-8", "replace")
+        question, _, answer = line.rpartition("-")
+        return question.strip(), normalize_answer(answer)
+
+
+#####################################################################################################################
+#       HANDSHAKE                                                                                                   #
+#####################################################################################################################
+#   The host sends a fixed header with the generation seed, the grid size, P1, P2, exit, the rules and the grid     #
+#   CRC32. The client rebuilds the dungeon from the seed and answers HS_OK if its checksum matches, HS_MAP          #
+#   otherwise. On HS_MAP (or if the host sent HS_MAP mode right away) the whole grid follows as size * size raw     #
+#   bytes. Either way the client stocks the entities itself, from the grid and the seed, and plays by the rules of  #
+#   the host, which override its own --hunt and --turn-timer.                                                       #
+#####################################################################################################################
+
+HANDSHAKE_HEAD = struct.Struct("!4sIH6HBfI")  # Mode, seed, size, P1, P2, exit, rules, turn timer, grid checksum
+HS_SEED = b"SEED"  # Header modes
+HS_MAP = b"MAP_"
+HS_OK = b"OK__"  # Client replies
+HS_HUNT = 1  # Rules bits: monsters hunt the players
+HS_NO_TIMER = 0.0  # Turn timer of a host without one
+
+
+# Receive exactly size bytes, since recv may return less than asked. A closed connection raises ConnectionAbortedError
+def recv_exact(conn, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionAbortedError("Connection closed by peer")
+        buf += chunk
+    return bytes(buf)
+
+
+# Rules bits and turn timer of the host, for the handshake header
+def handshake_rules():
+    return HS_HUNT if HUNTING else 0, HS_NO_TIMER if TURN_TIMER is None else TURN_TIMER
+
+
+# Pack the handshake header. With swap=True the client will play as P1 instead of P2
+def handshake_head(dungeon, mode, swap=False):
+    p1, p2 = (dungeon.p2, dungeon.p1) if swap else (dungeon.p1, dungeon.p2)
+    return HANDSHAKE_HEAD.pack(mode, dungeon.seed, dungeon.size, *p1, *p2, *dungeon.exit, *handshake_rules(),
+                               zlib.crc32(dungeon.data))
+
+
+# Host side of the handshake, seed_handshake overrides SEED_HANDSHAKE
+def send_dungeon(conn, dungeon, seed_handshake=None):
+    if seed_handshake is None:
+        seed_handshake = SEED_HANDSHAKE
+    mode = HS_SEED if seed_handshake and dungeon.layout == SEED_LAYOUT else HS_MAP
+    conn.sendall(handshake_head(dungeon, mode))
+
+    if mode == HS_MAP or recv_exact(conn, len(HS_OK)) != HS_OK:
+        conn.sendall(dungeon.data)  # Fallback: the client couldn't rebuild the map, send it byte for byte
+
+
+# Client side of the handshake. Returns the host dungeon, with P1 and P2 swapped because this is the second player,
+# and adopts the host rules for the games started from now on. Raises ValueError if the received map doesn't match
+# the host checksum.
+def receive_dungeon(conn):
+    global HUNTING, TURN_TIMER
+    mode, seed, size, p1x, p1y, p2x, p2y, ex, ey, rules, timer, checksum = \
+        HANDSHAKE_HEAD.unpack(recv_exact(conn, HANDSHAKE_HEAD.size))
+    HUNTING = bool(rules & HS_HUNT)
+    TURN_TIMER = None if timer == HS_NO_TIMER else timer
+
+    dungeon = DungeonGraph(True, size, seed, generate=mode == HS_SEED, layout=SEED_LAYOUT)
+
+    if mode == HS_SEED:
+        # Generation can differ across Python versions, so ask for the map if the checksum doesn't match
+        rebuilt = zlib.crc32(dungeon.data) == checksum
+        conn.sendall(HS_OK if rebuilt else HS_MAP)
+        if not rebuilt:
+            mode = HS_MAP
+
+    if mode == HS_MAP:
+        dungeon.data = bytearray(recv_exact(conn, size * size))
+        dungeon.distances.invalidate()
+        dungeon.sight.invalidate()
+        if zlib.crc32(dungeon.data) != checksum:
+            raise ValueError("Received map doesn't match the host checksum")
+        dungeon.entities.stock(dungeon.data, seed)
+
+    dungeon.p1, dungeon.p2, dungeon.exit = (p2x, p2y), (p1x, p1y), (ex, ey)
+    return dungeon
+
+
+#####################################################################################################################
+#       TURN PROTOCOL                                                                                               #
+#####################################################################################################################
+#   Every send is one frame: a 4 bytes length followed by a batch of messages. Each message is a type byte followed #
+#   by its packed fields, as given by MSG_LAYOUTS. MSG_SAY carries free text instead: a 2 bytes length and the      #
+#   UTF-8 encoded string. Messages are tuples (type, *fields), e.g. (MSG_POS, x, y) or (MSG_SAY, "Ciao!").          #
+#####################################################################################################################
+
+FRAME_HEAD = struct.Struct("!I")  # Payload length
+MAX_FRAME_SIZE = 0xFFFF  # Longer frames are rejected as malformed
+MSG_TYPE = struct.Struct("!B")
+SAY_HEAD = struct.Struct("!H")  # Text length in bytes
+SAY_MAX = MAX_FRAME_SIZE - FRAME_HEAD.size - MSG_TYPE.size - SAY_HEAD.size  # Longer texts are cut to fit in a frame
+MSG_LAYOUTS = {
+    MSG_DIE: struct.Struct("!"),
+    MSG_ESC: struct.Struct("!I"),  # Coins
+    MSG_CLR: struct.Struct("!HH"),  # Cleared room
+    MSG_POS: struct.Struct("!HH"),  # New position
+    MSG_ATK: struct.Struct("!"),
+    MSG_STL: struct.Struct("!"),
+    MSG_COIN: struct.Struct("!I"),  # Coins stolen
+    MSG_LUCK: struct.Struct("!H"),  # Luck roll when both players steal
+    MSG_SEAT: struct.Struct("!B"),
+    MSG_SNAP: struct.Struct("!"),
+    MSG_HIT: struct.Struct("!HHB"),  # Room, health points left
+    MSG_MNST: struct.Struct("!HHB"),  # Room, health points
+    MSG_NEAR: struct.Struct("!HH"),  # Position
+}
+
+
+# Pack a list of message tuples into a frame payload
+def pack_messages(messages):
+    payload = bytearray()
+    for msg in messages:
+        payload += MSG_TYPE.pack(msg[0])
+        if msg[0] == MSG_SAY:
+            text = msg[1].encode()[:SAY_MAX]
+            payload += SAY_HEAD.pack(len(text)) + text
+        else:
+            payload += MSG_LAYOUTS[msg[0]].pack(*msg[1:])
+    return bytes(payload)
+
+
+# Unpack a frame payload into a list of message tuples. Raises ValueError on unknown types or truncated payloads
+def unpack_messages(payload):
+    messages = []
+    offset = 0
+    try:
+        while offset < len(payload):
+            msg_type = payload[offset]
+            offset += MSG_TYPE.size
+            if msg_type == MSG_SAY:
+                length, = SAY_HEAD.unpack_from(payload, offset)
+                offset += SAY_HEAD.size
+                if offset + length > len(payload):
+                    raise ValueError("Truncated message text")
+                messages.append((MSG_SAY, payload[offset:offset + length].decode(errors="replace")))
+                offset += length
+            else:
+                layout = MSG_LAYOUTS[msg_type]
+                messages.append((msg_type,) + layout.unpack_from(payload, offset))
+                offset += layout.size
+    except (KeyError, struct.error) as e:
+        raise ValueError("Malformed frame: %s" % e)
+    return messages
+
+
+# Send all the given messages in a single frame. Raises ValueError if they don't fit in one
+def send_messages(conn, messages):
+    payload = pack_messages(messages)
+    if FRAME_HEAD.size + len(payload) > MAX_FRAME_SIZE:
+        raise ValueError("Frame too long: %d bytes" % len(payload))
+    conn.sendall(FRAME_HEAD.pack(len(payload)) + payload)
+
+
+# Receive a whole frame and return its messages
+def recv_messages(conn):
+    length, = FRAME_HEAD.unpack(recv_exact(conn, FRAME_HEAD.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame too long: %d bytes" % length)
+    return unpack_messages(recv_exact(conn, length))
+
+
+#####################################################################################################################
+#       GAME ENGINE                                                                                                 #
+#####################################################################################################################
+#   The whole game logic, without any terminal or socket. A front end creates a GameState, calls start() and then   #
+#   keeps calling step() with the action the state is waiting for, e.g. (ACT_MOVE, -1, 0) to go north. Each call    #
+#   returns the list of events that happened, as (EV_*, *data) tuples, for the front end to show. In multiplayer    #
+#   the front end also sends every frame in state.outbox to the opponent and feeds back each frame it receives as   #
+#   (ACT_REMOTE, msgs). A frame is either a whole turn, sent once the player moved, or a single encounter stage.    #
+#####################################################################################################################
+
+WAIT_MOVE = "move"  # What the state is waiting for
+WAIT_ANSWER = "answer"
+WAIT_ENCOUNTER = "encounter"
+WAIT_REMOTE = "remote"
+
+ACT_MOVE = "move"  # (ACT_MOVE, dx, dy), with (0, 0) to stay in place. Goes back instead if state.turnback is set
+ACT_CHEAT = "cheat"  # (ACT_CHEAT, code) for any other input while moving: the master code or a cheat
+ACT_ANSWER = "answer"  # (ACT_ANSWER, text) to the current quiz
+ACT_GREET = "greet"  # (ACT_GREET, text) to the stranger
+ACT_ATTACK = "attack"
+ACT_STEAL = "steal"
+ACT_REMOTE = "remote"  # (ACT_REMOTE, messages) received from the opponent
+
+ENC_REPLY = "reply"  # Encounter stages waiting on the opponent: its choice, the stolen coins or its luck roll
+ENC_COINS = "coins"
+ENC_LUCK = "luck"
+
+MASTER_CODE = "JUSTINBAILEY"
+ESCAPE_MOVES = 10  # Moves left after the opponent escaped
+
+EV_FRAME = "frame"  # The player entered a room: draw the map
+EV_FULL_MAP = "full_map"  # Draw the whole map
+EV_SCORE = "score"  # (EV_SCORE, opponent coins, player coins)
+EV_COMPASS = "compass"  # (EV_COMPASS, direction, steps to the exit or None)
+EV_FOUND = "found"  # (EV_FOUND, item room)
+EV_ALREADY_HAVE = "already_have"  # (EV_ALREADY_HAVE, item room)
+EV_OPP_SAYS = "opp_says"  # (EV_OPP_SAYS, text)
+EV_OPP_ESCAPED = "opp_escaped"  # (EV_OPP_ESCAPED, moves made since)
+EV_QUIZ = "quiz"  # (EV_QUIZ, question)
+EV_CHEATS = "cheats"  # (EV_CHEATS, enabled)
+EV_OPP_DEAD = "opp_dead"  # Events below only carry their name
+EV_STRANGER = "stranger"
+EV_OPP_TRIPS = "opp_trips"
+EV_ROBBED = "robbed"
+EV_KARMA = "karma"
+EV_COUNTERED = "countered"
+EV_REPELLED = "repelled"
+EV_STOLE_UNAWARE = "stole_unaware"
+EV_CAUGHT = "caught"
+EV_STOLE = "stole"
+EV_STALEMATE = "stalemate"
+EV_CORRIDOR = "corridor"
+EV_MONSTER = "monster"
+EV_MONSTER_SLAIN = "monster_slain"
+EV_MONSTER_HURT = "monster_hurt"
+EV_MONSTER_STANDS = "monster_stands"
+EV_MONSTER_BITES = "monster_bites"  # (EV_MONSTER_BITES, monsters next to the player)
+EV_CHEST = "chest"
+EV_CHEST_OPEN = "chest_open"
+EV_CHEST_LOCKED = "chest_locked"
+EV_TRAP = "trap"
+EV_TRAP_AVOIDED = "trap_avoided"
+EV_TRAP_DISARMED = "trap_disarmed"
+EV_GAS = "gas"
+EV_PIT = "pit"
+EV_QUIZ_RIGHT = "quiz_right"
+EV_ESCAPED_IN_TIME = "escaped_in_time"
+EV_UNKNOWN_ROOM = "unknown_room"
+EV_EXIT_NEARBY = "exit_nearby"
+EV_TRAPPED = "trapped"
+EV_DEAD = "dead"
+EV_WIN = "win"
+EV_WALL = "wall"
+EV_STAY = "stay"
+EV_UNKNOWN_INPUT = "unknown_input"
+
+ITEMS = (RM_COMP, RM_SWRD, RM_KNIFE, RM_LOCKP)
+ITEM_FLAGS = {RM_COMP: "has_compass", RM_SWRD: "has_sword", RM_KNIFE: "has_knife", RM_LOCKP: "has_lockpick"}
+CHEAT_ITEMS = {"triforce": "has_compass", "greyskull": "has_sword", "thievesguild": "has_lockpick",
+               "cutthroat": "has_knife"}
+
+
+# Everything a game needs besides the front end. The dungeon P1 is always this player.
+class GameState:
+    def __init__(self, dungeon, player, quizzes, multi=False, seed=None):
+        self.dungeon = dungeon
+        self.player = player
+        self.quizzes = quizzes  # Sequence of (question, answer) couples with normalized answers, e.g. a QuizBank
+        self.quizzes_drawn = 0
+        self.quizzes_swapped = {}  # Lazy shuffle of the quiz indexes: position -> index, for the moved ones only
+        self.multi = multi
+        self.rng = random.Random(seed)  # Gameplay randomness, separate from the dungeon generation one
+        self.cheats_enabled = False
+        self.waiting = WAIT_MOVE
+        self.over = False
+        self.batch = []  # Messages for the opponent, until the turn or the encounter stage is over
+        self.outbox = []  # Frames for the opponent, as lists of messages. The front end sends and clears them
+        self.turns = 0
+        self.previous_tile = dungeon.p1
+        self.exit_found = False  # Whether the exit is next to the current room
+        self.escaped = False
+        self.opponent_escaped = False
+        self.opponent_dead = False
+        self.wait_opponent = False  # Escaped first: keep receiving until the opponent is done
+        self.movs_to_esc = 0
+        self.opponent_gold = -1
+        self.turnback = False  # After an encounter the player walks back to the previous room
+        self.quiz = None  # Quiz waiting for an answer
+        self.encounter = None  # (choice, ENC_* stage) of an encounter waiting on the opponent
+        self.luck = 0
+        self.hunting = HUNTING  # Monsters come after this player
+        self.flow = None  # FlowField of this player, when hunting
+        self.claims = None  # FlowField of where both players were when the turn began, when hunting in multiplayer
+        self.turn_start = dungeon.p1, dungeon.p2  # Set as each room is entered
+
+
+# Enter the first room. Returns the state and its events, like step()
+def start(state):
+    events = []
+    enter_room(state, events)
+    return state, events
+
+
+# Apply an action to the state. The state is updated in place and returned along with the list of events.
+# Raises ValueError if the state isn't waiting for that kind of action.
+def step(state, action):
+    events = []
+    kind = action[0]
+
+    if state.waiting == WAIT_MOVE and kind == ACT_MOVE:
+        move(state, action[1], action[2], events)
+    elif state.waiting == WAIT_MOVE and kind == ACT_CHEAT:
+        cheat(state, action[1], events)
+    elif state.waiting == WAIT_ANSWER and kind == ACT_ANSWER:
+        answer_quiz(state, action[1], events)
+    elif state.waiting == WAIT_ENCOUNTER and kind in (ACT_GREET, ACT_ATTACK, ACT_STEAL):
+        choose(state, action, events)
+    elif state.waiting == WAIT_REMOTE and kind == ACT_REMOTE:
+        if state.encounter is not None:
+            receive_encounter(state, action[1], events)
+        else:
+            receive_turn(state, action[1], events)
+    else:
+        raise ValueError("Action %s while waiting for %s" % (kind, state.waiting))
+
+    return state, events
+
+
+# The connection with the opponent dropped: go on alone
+def disconnect(state):
+    events = []
+    state.multi = False
+    state.dungeon.p2 = None
+    state.batch.clear()
+    state.outbox.clear()
+
+    if state.waiting == WAIT_REMOTE:
+        if state.encounter is not None:
+            state.encounter = None
+            await_move(state, events)
+        else:
+            finish_turn(state, events)
+    elif state.waiting == WAIT_ENCOUNTER:
+        await_move(state, events)
+
+    return events
+
+
+def send(state, msg):
+    if state.multi:
+        state.batch.append(msg)
+
+
+# Close the messages sent so far into one frame. The opponent takes each frame for a whole turn or encounter stage
+def flush(state):
+    if state.batch:
+        state.outbox.append(state.batch)
+        state.batch = []
+
+
+# Discover nearby rooms and resolve what's in the current one
+def enter_room(state, events):
+    dungeon, player = state.dungeon, state.player
+    curr_tile = dungeon.p1
+    room = dungeon.get(curr_tile)
+    state.turn_start = dungeon.p1, dungeon.p2
+
+    # Discover the rooms in sight if Wall, Empty or Exit, plus current cell in any case. What's in the others stays
+    # unknown until entered
+    newly_discovered = [pos for pos in dungeon.sight.visible(curr_tile) if
+                        dungeon.get(pos) in (RM_WALL, RM_EXIT, RM_EMPTY)] + [curr_tile]
     player.discover(newly_discovered)
+    state.exit_found = dungeon.exit in dungeon.get_nearby(curr_tile)  # Flag exit_found if the exit is nearby
+    events.append((EV_FRAME,))
+
+    if state.opponent_escaped:
+        events.append((EV_OPP_ESCAPED, state.movs_to_esc))
+    elif state.opponent_dead:
+        events.append((EV_OPP_DEAD,))
+        state.opponent_dead = False
+
+    if player.has_compass:
+        direction = "Ovest"
+        ang = math.atan2(dungeon.p1[0] - dungeon.exit[0], dungeon.exit[1] - dungeon.p1[1])
+        for i in range(7):
+            max_ang = math.pi * (7 - 2*i) / 8
+            min_ang = math.pi * (5 - 2*i) / 8
+            if min_ang < ang <= max_ang:
+                direction = DIRECTIONS[i]
+                break
+        events.append((EV_COMPASS, direction, dungeon.distance(dungeon.p1)))
+
+    # Player encounter cases
+    if dungeon.p1 == dungeon.p2:
+        state.turnback = True
+        state.waiting = WAIT_ENCOUNTER
+        events.append((EV_STRANGER,))
+        return
+
+    elif room == RM_EMPTY:
+        events.append((EV_CORRIDOR,))
+
+    # "Mechanics" rooms cases
+    elif room == RM_MNST:
+        events.append((EV_MONSTER,))
+        store, idx = dungeon.entity(curr_tile)
+        hp = store.hp[idx] - (SWORD_DAMAGE if player.has_sword else 1)
+
+        if hp <= 0 and player.has_sword:
+            events.append((EV_MONSTER_SLAIN,))
+            clear_room(state)
+        elif hp <= 0:
+            player.attacked(1)
+            events.append((EV_MONSTER_HURT,))
+            clear_room(state)
+        else:  # Still standing: it hits back and the player retreats
+            player.attacked(1)
+            store.hp[idx] = hp
+            state.turnback = True
+            events.append((EV_MONSTER_STANDS,))
+            send(state, (MSG_HIT,) + curr_tile + (hp,))
+
+    elif room == RM_CHEST:
+        events.append((EV_CHEST,))
+
+        if player.has_lockpick:
+            events.append((EV_CHEST_OPEN,))
+            store, idx = dungeon.entity(curr_tile)
+            player.coin += store.loot[idx]
+            clear_room(state)
+        else:
+            events.append((EV_CHEST_LOCKED,))
 
-    # Flag exit_found if the exit is nearby
-    exit_nearby = dungeon.exit in newly_discovered
+    elif room == RM_TRAP:
+        events.append((EV_TRAP,))
 
-    # Print UI
-    dungeon.print_hidden(curr_tile, DUNGEON_SIGHT, player)
-    return new_room, curr_tile, exit_nearby
+        if state.rng.random() < TRAP_AVOID_CHANCE:
+            events.append((EV_TRAP_AVOIDED,))
+        elif player.has_knife:
+            events.append((EV_TRAP_DISARMED,))
+        else:
+            store, idx = dungeon.entity(curr_tile)
+            punish(state, events, store.traps[idx] == TRAP_GAS)
 
+        clear_room(state)
 
-# Get input from player and decide the next cell. Cheats can be input here as well.
-# Master code: JUSTINBAILEY
-def move(curr_tile, socket, dungeon, player):
-    x, y, nx, ny = None, None, None, None
-    global cheats_enabled
-
-    while True:
-        print("Dove desideri andare? (Tasti WASD per muoversi, 'quit' per uscire)")
-
-        pl_input = input()
-        x, y = curr_tile
-        nx, ny = x, y
-
-        if pl_input == 'w':
-            nx = x - 1
-        elif pl_input == 'a':
-            ny = y - 1
-        elif pl_input == 's':
-            nx = x + 1
-        elif pl_input == 'd':
-            ny = y + 1
-        elif pl_input == '':
-            print("Decidi di restare qui")
-        elif pl_input == 'JUSTINBAILEY':
-            cheats_enabled = not cheats_enabled
-            print("Trucchi abilitati!" if cheats_enabled else "Trucchi disabilitati!")
-            continue
-        elif pl_input == "quit":
-            if socket is not None:
-                socket.close()
-            exit()
-        elif cheats_enabled:
-            if pl_input == "triforce":      # Get the compass
-                player.has_compass = True
-                continue
-            elif pl_input == "greyskull":   # Get the sword
-                player.has_sword = True
-                continue
-            elif pl_input == "thievesguild":    # Get the lockpick
-                player.has_lockpick = True
-                continue
-            elif pl_input == "cutthroat":   # Get the knife
-                player.has_knife = True
-                continue
-            elif pl_input == "brighteyes":  # Cheat for printing the whole map
-                dungeon.print()
-                continue
-            elif pl_input == "seppuku":  # Cheat for suicide
-                player.attacked(player.health)
-            elif pl_input == "escaperope":  # Cheat for exit
-                dungeon.set(dungeon.p1, RM_EXIT)
+    elif room == RM_QUIZ:
+        state.quiz = draw_quiz(state)
+        state.waiting = WAIT_ANSWER
+        events.append((EV_QUIZ, state.quiz[0]))
+        return
+
+    # Item rooms cases
+    elif room in ITEMS:
+        events.append((EV_FOUND, room))
+
+        if getattr(player, ITEM_FLAGS[room]):
+            events.append((EV_ALREADY_HAVE, room))
         else:
-            print("Input non riconosciuto.")
-            continue
+            setattr(player, ITEM_FLAGS[room], True)
+            clear_room(state)
+
+    # Other cases
+    elif room == RM_EXIT:
+        state.escaped = True
+
+        if state.multi:
+            send(state, (MSG_ESC, player.coin))   # Send escape message and Gold amount
+
+            if not state.opponent_escaped:  # First player to get out, must wait
+                state.wait_opponent = True
+            else:
+                events.append((EV_ESCAPED_IN_TIME,))    # Second player to get out
+
+        end_turn(state, events)
+        return
+
+    else:
+        events.append((EV_UNKNOWN_ROOM,))
+
+    await_move(state, events)
+
+
+# Empty the current room, for both players
+def clear_room(state):
+    state.dungeon.set(state.dungeon.p1, RM_EMPTY)
+    send(state, (MSG_CLR,) + state.dungeon.p1)
+
+
+# Poison gas or trapdoor, as given or by GAS_CHANCE
+def punish(state, events, gas=None):
+    if gas is None:
+        gas = state.rng.random() < GAS_CHANCE
+    if gas:
+        state.player.attacked(2)
+        events.append((EV_GAS,))
+    else:
+        state.player.coin = int(state.player.coin * 0.75)
+        events.append((EV_PIT,))
+
+
+# A quiz not drawn yet in this game, reshuffling the whole bank once they have all been drawn
+def draw_quiz(state):
+    if state.quizzes_drawn == len(state.quizzes):
+        state.quizzes_drawn = 0
+        state.quizzes_swapped.clear()
+
+    swapped = state.quizzes_swapped
+    pick = state.rng.randrange(state.quizzes_drawn, len(state.quizzes))
+    index = swapped.get(pick, pick)
+    swapped[pick] = swapped.get(state.quizzes_drawn, state.quizzes_drawn)
+    state.quizzes_drawn += 1
+    return state.quizzes[index]
+
+
+def answer_quiz(state, answer, events):
+    if normalize_answer(answer) == state.quiz[1]:
+        events.append((EV_QUIZ_RIGHT,))
+        state.player.coin += state.rng.randrange(TREASURE_MIN, TREASURE_MAX)
+    else:
+        punish(state, events)
+
+    state.quiz = None
+    clear_room(state)
+    await_move(state, events)
 
-        next_room = dungeon.get((nx, ny))
+
+def await_move(state, events):
+    if state.exit_found:
+        events.append((EV_EXIT_NEARBY,))
+    state.waiting = WAIT_MOVE
+
+
+# Move by (dx, dy), or back to the previous room after an encounter. Bumping into a wall doesn't end the turn.
+def move(state, dx, dy, events):
+    dungeon = state.dungeon
+
+    if state.turnback:
+        state.turnback = False
+        dungeon.p1 = state.previous_tile
+    else:
+        x, y = dungeon.p1
+        next_tile = x + dx, y + dy
+
+        if (dx, dy) == (0, 0):
+            events.append((EV_STAY,))
 
         # Bump if wall or out of bounds
+        next_room = dungeon.get(next_tile)
         if next_room == RM_WALL or next_room is None:
-            print("Vi è un muro in quella direzione.")
+            events.append((EV_WALL,))
+            return
+
+        state.previous_tile, dungeon.p1 = dungeon.p1, next_tile
+
+    end_move(state, events)
+
+
+# Any input other than a move. Cheats need the master code first
+def cheat(state, code, events):
+    player = state.player
+
+    if code == MASTER_CODE:
+        state.cheats_enabled = not state.cheats_enabled
+        events.append((EV_CHEATS, state.cheats_enabled))
+    elif not state.cheats_enabled:
+        events.append((EV_UNKNOWN_INPUT,))
+    elif code in CHEAT_ITEMS:
+        setattr(player, CHEAT_ITEMS[code], True)
+    elif code == "brighteyes":  # Cheat for printing the whole map
+        events.append((EV_FULL_MAP,))
+    elif code == "seppuku":  # Cheat for suicide, then stay
+        player.attacked(player.health)
+        state.previous_tile = state.dungeon.p1
+        end_move(state, events)
+    elif code == "escaperope":  # Cheat for exit, then stay
+        state.dungeon.set(state.dungeon.p1, RM_EXIT)
+        state.previous_tile = state.dungeon.p1
+        end_move(state, events)
+    else:
+        events.append((EV_UNKNOWN_INPUT,))
+
+
+def end_move(state, events):
+    if state.opponent_escaped and (state.movs_to_esc < ESCAPE_MOVES):  # Opponent got out, only a few moves left
+        state.movs_to_esc += 1
+
+        if state.movs_to_esc == ESCAPE_MOVES:
+            events.append((EV_TRAPPED,))
+            state.player.attacked(state.player.health)  # DEAD X_X
+
+    if state.hunting:
+        hunt(state, events)
+    end_turn(state, events)
+
+
+# Steps to the nearest of some origin rooms from the rooms within HUNT_RANGE, through anything but walls, as a
+# pos -> steps dict in BFS order. It only depends on the origins and on the walls, which never change during a game, so
+# it's computed again only when the origins move, whatever the number of monsters following them. The range bounds the
+# cost on huge maps.
+class FlowField:
+    def __init__(self, dungeon):
+        self.dungeon = dungeon
+        self.origins = None
+        self.steps = {}
+        self.nearest = {}  # Pos -> index of the nearest origin. Ties go to whichever the search reached first
+
+    def update(self, *origins):
+        if origins == self.origins:
+            return
+        self.origins = origins
+        self.steps = dict.fromkeys(origins, 0)
+        self.nearest = {origin: i for i, origin in enumerate(origins)}
+        frontier = list(origins)
+        for step in range(1, HUNT_RANGE + 1):
+            reached = []
+            for pos in frontier:
+                for near in self.dungeon.get_nearby(pos):
+                    if near not in self.steps and self.dungeon.get(near) not in (RM_WALL, None):
+                        self.steps[near] = step
+                        self.nearest[near] = self.nearest[pos]
+                        reached.append(near)
+            frontier = reached
+
+
+# Every HUNT_PACE turns, each monster within HUNT_RANGE takes a step down the player flow field, nearest first, into
+# empty rooms only. The ones next to the player may bite. Moves are sent as a MSG_CLR of the room left and a MSG_MNST of
+# the new one. In multiplayer each side only moves the monsters closer to where its player was when the turn began than
+# to where the opponent was. Both sides know these two rooms and search from them in the same order, so every monster
+# is moved by one side at most, and none while the players meet. Monsters never leave or enter the rooms of the players
+# either, where rooms get cleared. Two monsters may still walk into the same room, one from each side: see walk_in.
+def hunt(state, events):
+    dungeon = state.dungeon
+    if state.flow is None:
+        state.flow, state.claims = FlowField(dungeon), FlowField(dungeon)
+    state.flow.update(dungeon.p1)
+    steps = state.flow.steps
+    players = (dungeon.p1, dungeon.p2)
+    left = set()
+
+    own, rival = state.turn_start
+    shared = rival is not None  # Monsters split between the two sides
+    if shared and own != rival:
+        origins = min(own, rival), max(own, rival)
+        state.claims.update(*origins)
+        owner = origins.index(own)
+
+    movers = steps.items() if state.turns % HUNT_PACE == 0 else ()
+    for pos, dist in movers:
+        if dist < 2 or pos == dungeon.p2 or dungeon.get(pos) != RM_MNST:
             continue
-        break
+        if shared and (own == rival or state.claims.nearest.get(pos) != owner):
+            continue
+        for near in dungeon.get_nearby(pos):
+            if steps.get(near) == dist - 1 and dungeon.get(near) == RM_EMPTY and near not in players and \
+                    near not in left:
+                left.add(pos)
+                store, idx = dungeon.entity(pos)
+                hp = store.hp[idx]
+                dungeon.set(pos, RM_EMPTY)
+                dungeon.set(near, RM_MNST)
+                store, idx = dungeon.entity(near)
+                store.hp[idx] = hp
+                send(state, (MSG_CLR,) + pos)
+                send(state, (MSG_MNST,) + near + (hp,))
+                break
 
-    return curr_tile, (nx, ny)
+    bites = sum(dungeon.get(near) == RM_MNST and state.rng.random() < HUNT_BITE_CHANCE
+                for near in dungeon.get_nearby(dungeon.p1))
+    if bites:
+        state.player.attacked(bites)
+        events.append((EV_MONSTER_BITES, bites))
+
+
+# Queue the turn messages for the opponent and wait for its move, if it's still playing
+def end_turn(state, events):
+    if state.multi:
+        send(state, (MSG_POS,) + state.dungeon.p1)  # Queueing my position
+
+        if not state.player.attacked(0):    # Queueing whether I'm dead
+            send(state, (MSG_DIE,))
+        flush(state)
+
+        if not (state.opponent_escaped or state.opponent_dead):
+            state.waiting = WAIT_REMOTE
+            return
+
+    finish_turn(state, events)
+
+
+def finish_turn(state, events):
+    if not state.player.attacked(0):
+        events.append((EV_DEAD,))
+        state.over = True
+
+    elif state.escaped:
+        events.append((EV_WIN,))
+        if state.opponent_gold != -1:
+            events.append((EV_SCORE, state.opponent_gold, state.player.coin))
+        state.over = True
+
+    else:
+        state.turns += 1
+        enter_room(state, events)
+
+
+def receive_turn(state, messages, events):
+    dungeon = state.dungeon
+    dungeon.others = [msg[1:] for msg in messages if msg[0] == MSG_NEAR]  # Until the next turn
+
+    for msg in messages:
+        if msg[0] == MSG_POS and not state.opponent_escaped:
+            dungeon.p2 = msg[1], msg[2]
+        elif msg[0] == MSG_ESC:
+            state.opponent_escaped = True  # First player got out
+            state.opponent_gold = msg[1]
+            dungeon.p2 = None
+        elif msg[0] == MSG_DIE:
+            state.opponent_dead = True
+            dungeon.p2 = None
+            state.multi = False
+        elif msg[0] == MSG_CLR:
+            dungeon.set((msg[1], msg[2]), RM_EMPTY)
+        elif msg[0] == MSG_HIT:
+            store, idx = dungeon.entity((msg[1], msg[2]))
+            store.hp[idx] = msg[3]
+        elif msg[0] == MSG_MNST:
+            walk_in(dungeon, (msg[1], msg[2]), msg[3])
+
+    # Keep receiving if you are waiting the opponent and said opponent didn't die yet
+    if not state.wait_opponent or state.opponent_escaped or state.opponent_dead:
+        finish_turn(state, events)
+
+
+# A monster walked in from the opponent side. If one of ours did too, keep the healthier one, on both sides
+def walk_in(dungeon, pos, hp):
+    store, idx = dungeon.entity(pos)
+    if dungeon.get(pos) == RM_MNST:
+        hp = max(hp, store.hp[idx])
+    dungeon.set(pos, RM_MNST)
+    store, idx = dungeon.entity(pos)
+    store.hp[idx] = hp
+
+
+def choose(state, action, events):
+    player = state.player
+
+    if action[0] == ACT_GREET:
+        send(state, (MSG_SAY, action[1]))
+    elif action[0] == ACT_ATTACK and player.has_sword:
+        send(state, (MSG_ATK,))
+    elif action[0] == ACT_STEAL and player.has_knife:
+        send(state, (MSG_STL,))
+    else:
+        events.append((EV_UNKNOWN_INPUT,))
+        return
+
+    if state.multi:
+        flush(state)
+        state.encounter = action[0], ENC_REPLY
+        state.waiting = WAIT_REMOTE
+    else:
+        await_move(state, events)
+
+
+# Lose a quarter of the coins to the opponent
+def robbed(state, events):
+    events.append((EV_ROBBED,))
+    coin_lost = int(state.player.coin * 0.25)
+    state.player.coin -= coin_lost
+    send(state, (MSG_COIN, coin_lost))
+
+
+def receive_encounter(state, messages, events):
+    player = state.player
+    choice, stage = state.encounter
+    msg = messages[0]
+    state.encounter = None  # Done unless a stage below waits again
+
+    if stage == ENC_COINS:
+        player.coin += msg[1]
+
+    elif stage == ENC_LUCK:
+        if state.luck < msg[1]:
+            robbed(state, events)
+        elif state.luck > msg[1]:
+            events.append((EV_STOLE,))
+            state.encounter = choice, ENC_COINS
+        else:
+            events.append((EV_STALEMATE,))
+
+    # Handle "Greet" cases
+    elif choice == ACT_GREET:
+        if msg[0] == MSG_SAY:
+            events.append((EV_OPP_SAYS, msg[1]))
+        elif msg[0] == MSG_ATK:
+            events.append((EV_OPP_TRIPS,))
+        elif msg[0] == MSG_STL:
+            robbed(state, events)
+
+    # Handle "Attack" cases
+    elif choice == ACT_ATTACK:
+        if msg[0] == MSG_SAY:
+            events.append((EV_KARMA,))
+            player.coin = int(player.coin * 0.75)
+        elif msg[0] == MSG_ATK:
+            events.append((EV_COUNTERED,))
+            player.attacked(1)
+        elif msg[0] == MSG_STL:
+            events.append((EV_REPELLED,))
+
+    # Handle "Steal" cases
+    elif choice == ACT_STEAL:
+        if msg[0] == MSG_SAY:
+            events.append((EV_STOLE_UNAWARE,))
+            state.encounter = choice, ENC_COINS
+        elif msg[0] == MSG_ATK:
+            events.append((EV_CAUGHT,))
+            player.attacked(2)
+        elif msg[0] == MSG_STL:
+            state.luck = state.rng.randrange(1, 1000)
+            send(state, (MSG_LUCK, state.luck))
+            state.encounter = choice, ENC_LUCK
+
+    flush(state)  # Coins or luck roll, right away: the opponent waits on them
+    if state.encounter is None:
+        await_move(state, events)
 
 
-def play():
-    print("  _______ _________   ___    ___  __  ___  _______________  _  ______")
-    print(" / ___/ // / __/ _ | / _ \  / _ \/ / / / |/ / ___/ __/ __ \/ |/ / __/")
-    print("/ /__/ _  / _// __ |/ ___/ / // / /_/ /    / (_ / _// /_/ /    /\ \  ")
-    print("\___/_//_/___/_/ |_/_/    /____/\____/_/|_/\___/___/\____/_/|_/___/  ")
-    print()
-    print("Benvenuto a Cheap Dungeons!")
-    print("Vuoi giocare in solo o con un amico? s/a")
-    multi = input() == "a"
+#####################################################################################################################
+#       SAVE FILES                                                                                                  #
+#####################################################################################################################
+#   A saved game is a fixed size header (SAVE_HEAD), the gameplay random generator state (SAVE_RNG), the grid with  #
+#   4 bits per room (two rooms per byte, first one in the high half), the player fog bitmap as it is in memory, the #
+#   entities (see EntityStore.pack) and the moved indexes of the quiz shuffle (see draw_quiz), as position, index   #
+#   pairs. Every part but the last two starts at an offset known from the header alone, so loading parses nothing   #
+#   but the header, and the grid and fog are turned back into bytearrays by a few C level translate and slice       #
+#   calls. Whole dungeons only.                                                                                     #
+#####################################################################################################################
 
-    dungeon = DungeonGraph(multi)
-    player = Player()
+SAVE_MAGIC = b"CDSV"
+SAVE_VERSION = 3
+SAVE_FILE = "cheap-dungeons.sav"  # Default save file, in the working directory
+# Magic, version, seed, size, flags, P1, P2, exit, previous tile, health, coins, items, name, turns, moves to escape,
+# opponent gold, luck, waiting, quizzes drawn, moved quiz indexes
+SAVE_HEAD = struct.Struct("!4sHIHH8HHIB32sIHiHBII")
+SAVE_RNG = struct.Struct("!625Id")  # random.Random internal state and its spare gauss value (NaN if None)
+SAVE_NO_POS = 0xFFFF, 0xFFFF  # P2 when there is none
+SAVE_FLAGS = ("multi", "cheats_enabled", "exit_found", "escaped", "opponent_escaped", "opponent_dead",
+              "wait_opponent", "turnback", "hunting")  # GameState booleans, one bit each from the lowest
+SAVE_WAITS = (WAIT_MOVE, WAIT_ANSWER, WAIT_ENCOUNTER, WAIT_REMOTE)
+SAVE_ROOMS = (RM_WALL + RM_EMPTY + RM_EXIT + RM_MNST + RM_TRAP + RM_QUIZ + RM_CHEST + RM_KNIFE + RM_SWRD + RM_COMP +
+              RM_LOCKP).encode()  # Room of each 4 bits code
+SAVE_ENCODE = bytes(SAVE_ROOMS.find(i) if i in SAVE_ROOMS else 0 for i in range(256))  # Room byte -> code
+SAVE_ENCODE_HIGH = bytes(code << 4 for code in SAVE_ENCODE)
+# Packed byte -> first and second room. Codes out of SAVE_ROOMS are read as walls
+SAVE_DECODE_HIGH = bytes(SAVE_ROOMS[i >> 4] if i >> 4 < len(SAVE_ROOMS) else SAVE_ROOMS[0] for i in range(256))
+SAVE_DECODE_LOW = bytes(SAVE_ROOMS[i & 15] if i & 15 < len(SAVE_ROOMS) else SAVE_ROOMS[0] for i in range(256))
+
+
+# The game as bytes. Only between a move and the next: not with a quiz or an encounter waiting
+def pack_game(state):
+    dungeon, player = state.dungeon, state.player
+    if not isinstance(dungeon, DungeonGraph):
+        raise ValueError("only whole dungeons can be saved")
+    if state.quiz is not None or state.encounter is not None:
+        raise ValueError("can't save with a quiz or an encounter going on")
+
+    flags = sum(1 << i for i, name in enumerate(SAVE_FLAGS) if getattr(state, name))
+    items = sum(1 << i for i, room in enumerate(ITEMS) if getattr(player, ITEM_FLAGS[room]))
+    head = SAVE_HEAD.pack(SAVE_MAGIC, SAVE_VERSION, dungeon.seed & 0xFFFFFFFF, dungeon.size, flags,
+                          *dungeon.p1, *(dungeon.p2 or SAVE_NO_POS), *dungeon.exit, *state.previous_tile,
+                          player.health, player.coin, items, player.name.encode()[:32], state.turns,
+                          state.movs_to_esc, state.opponent_gold, state.luck, SAVE_WAITS.index(state.waiting),
+                          state.quizzes_drawn, len(state.quizzes_swapped))
+
+    _, internal, gauss = state.rng.getstate()
+    rng = SAVE_RNG.pack(*internal, math.nan if gauss is None else gauss)
+
+    # Pair the rooms up and merge each couple of codes with one big integer OR
+    rooms = dungeon.data + dungeon.data[:len(dungeon.data) & 1]  # Pad to an even count
+    high = rooms[0::2].translate(SAVE_ENCODE_HIGH)
+    low = rooms[1::2].translate(SAVE_ENCODE)
+    grid = (int.from_bytes(high, "big") | int.from_bytes(low, "big")).to_bytes(len(high), "big")
+
+    swapped = array("I", itertools.chain.from_iterable(state.quizzes_swapped.items()))
+    if sys.byteorder == "little":
+        swapped.byteswap()
+
+    return head + rng + grid + player.discovered + dungeon.entities.pack(dungeon.data) + swapped.tobytes()
+
+
+def save_game(state, path=SAVE_FILE):
+    with open(path, "wb") as save_file:
+        save_file.write(pack_game(state))
+
+
+# Rebuild a GameState from pack_game bytes (or anything sliceable, like an mmap). Raises ValueError if they're not
+# a save of this version
+def unpack_game(buffer, quizzes):
+    if len(buffer) < SAVE_HEAD.size + SAVE_RNG.size:
+        raise ValueError("truncated save")
+    (magic, version, seed, size, flags, p1x, p1y, p2x, p2y, exit_x, exit_y, prev_x, prev_y, health, coin, items, name,
+     turns, movs_to_esc, opponent_gold, luck, waiting, drawn, moved) = SAVE_HEAD.unpack_from(buffer)
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        raise ValueError("not a version %d save" % SAVE_VERSION)
+
+    grid_start = SAVE_HEAD.size + SAVE_RNG.size
+    fog_start = grid_start + (size * size + 1) // 2
+    entities_start = fog_start + (size * size + 7) // 8
+    if len(buffer) < entities_start:
+        raise ValueError("save size doesn't match its dungeon")
+
+    dungeon = DungeonGraph(False, size, seed, generate=False)
+    grid = buffer[grid_start:fog_start]
+    rooms = bytearray(2 * len(grid))
+    rooms[0::2] = grid.translate(SAVE_DECODE_HIGH)
+    rooms[1::2] = grid.translate(SAVE_DECODE_LOW)
+    dungeon.data[:] = rooms[:size * size]
+    quizzes_start = entities_start + EntityStore.packed_size(dungeon.data)
+    if len(buffer) != quizzes_start + 8 * moved:
+        raise ValueError("save size doesn't match its dungeon")
+    dungeon.entities.unpack(dungeon.data, buffer[entities_start:quizzes_start])
+    dungeon.p1, dungeon.exit = (p1x, p1y), (exit_x, exit_y)
+    dungeon.p2 = None if (p2x, p2y) == SAVE_NO_POS else (p2x, p2y)
+
+    player = Player(size)
+    player.name = name.rstrip(b"\0").decode("utf-8", "ignore")
+    player.health, player.coin = health, coin
+    for i, room in enumerate(ITEMS):
+        setattr(player, ITEM_FLAGS[room], items >> i & 1 == 1)
+    player.discovered[:] = buffer[fog_start:entities_start]
+
+    state = GameState(dungeon, player, quizzes)
+    for i, flag in enumerate(SAVE_FLAGS):
+        setattr(state, flag, flags >> i & 1 == 1)
+    state.previous_tile = prev_x, prev_y
+    state.turns, state.movs_to_esc, state.opponent_gold, state.luck = turns, movs_to_esc, opponent_gold, luck
+    state.waiting = SAVE_WAITS[waiting]
+    swapped = array("I", bytes(buffer[quizzes_start:]))
+    if sys.byteorder == "little":
+        swapped.byteswap()
+    state.quizzes_drawn = drawn
+    state.quizzes_swapped = dict(zip(swapped[0::2], swapped[1::2]))
+
+    *internal, gauss = SAVE_RNG.unpack_from(buffer, SAVE_HEAD.size)
+    state.rng.setstate((3, tuple(internal), None if math.isnan(gauss) else gauss))
+    return state
+
+
+# Load a saved game, mapping the file instead of reading it
+def load_game(path=SAVE_FILE, quizzes=()):
+    with open(path, "rb") as save_file:
+        if os.fstat(save_file.fileno()).st_size == 0:
+            raise ValueError("empty save")
+        with mmap.mmap(save_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return unpack_game(buffer, quizzes)
+
+
+#####################################################################################################################
+#       REPLAYS                                                                                                     #
+#####################################################################################################################
+#   A replay log is REPLAY_HEAD, the starting GameState as a save (see SAVE FILES, so the seed and the map are in   #
+#   there), then one record per engine call: a code byte, a 2 bytes length and the payload. Moves are two signed    #
+#   bytes, cheats, answers and greetings their UTF-8 text, received messages a TURN PROTOCOL payload. Given the     #
+#   same quiz bank, the engine is fully determined by these, so replay() runs the game again without a terminal or  #
+#   a socket, times every turn and checks the outcome against the REPLAY_END record written when the game ended.    #
+#####################################################################################################################
+
+REPLAY_MAGIC = b"CDRL"
+REPLAY_VERSION = 2
+REPLAY_FILE = "cheap-dungeons.replay"  # Default replay log, in the working directory
+REPLAY_HEAD = struct.Struct("!4sHII")  # Magic, version, quizzes in the bank, length of the starting save
+REPLAY_RECORD = struct.Struct("!BH")  # Code, payload length
+REPLAY_ACTIONS = (ACT_MOVE, ACT_CHEAT, ACT_ANSWER, ACT_GREET, ACT_ATTACK, ACT_STEAL, ACT_REMOTE)  # Code - 1
+REPLAY_DISCONNECT = 0  # Record code of disconnect()
+REPLAY_STOP = 0xFF  # Record code of the final state, packed as REPLAY_END
+REPLAY_END = struct.Struct("!IHIHHBII")  # Turns, health, coins, P1, over and escaped flags, grid and fog CRC32
+REPLAY_MOVE = struct.Struct("!bb")
+REPLAY_SLOWEST = 5  # Slowest turns listed in a replay report
+
+
+# What replay() checks at the end, as REPLAY_END bytes
+def replay_digest(state):
+    return REPLAY_END.pack(state.turns, state.player.health, state.player.coin, *state.dungeon.p1,
+                           state.over | state.escaped << 1, zlib.crc32(state.dungeon.data),
+                           zlib.crc32(state.player.discovered))
+
+
+# Writes the replay log of a game, as it's played. Raises ValueError if the game can't be saved (see pack_game)
+class ReplayRecorder:
+    def __init__(self, path, state):
+        snapshot = pack_game(state)
+        self.file = open(path, "wb")
+        self.file.write(REPLAY_HEAD.pack(REPLAY_MAGIC, REPLAY_VERSION, len(state.quizzes), len(snapshot)) + snapshot)
+
+    def record(self, code, payload=b""):
+        self.file.write(REPLAY_RECORD.pack(code, len(payload)) + payload)
+
+    # Call before passing action to step()
+    def action(self, action):
+        kind = action[0]
+        if kind == ACT_MOVE:
+            payload = REPLAY_MOVE.pack(action[1], action[2])
+        elif kind in (ACT_CHEAT, ACT_ANSWER, ACT_GREET):
+            payload = action[1].encode()[:0xFFFF]
+        elif kind == ACT_REMOTE:
+            payload = pack_messages(action[1])
+        else:
+            payload = b""
+        self.record(REPLAY_ACTIONS.index(kind) + 1, payload)
+
+    def disconnect(self):
+        self.record(REPLAY_DISCONNECT)
+
+    # Write the final state and close the log
+    def close(self, state):
+        self.record(REPLAY_STOP, replay_digest(state))
+        self.file.close()
+
+
+# Split a replay log into the starting state save, the quiz count and the list of (code, payload) records
+def read_replay(buffer):
+    magic, version, quiz_count, snapshot_len = REPLAY_HEAD.unpack_from(buffer)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError("not a version %d replay" % REPLAY_VERSION)
+
+    offset = REPLAY_HEAD.size + snapshot_len
+    snapshot = buffer[REPLAY_HEAD.size:offset]
+    records = []
+    while offset < len(buffer):
+        code, length = REPLAY_RECORD.unpack_from(buffer, offset)
+        offset += REPLAY_RECORD.size
+        records.append((code, buffer[offset:offset + length]))
+        offset += length
+    return snapshot, quiz_count, records
+
+
+def replay_action(code, payload):
+    kind = REPLAY_ACTIONS[code - 1]
+    if kind == ACT_MOVE:
+        return (kind,) + REPLAY_MOVE.unpack(payload)
+    elif kind in (ACT_CHEAT, ACT_ANSWER, ACT_GREET):
+        return kind, payload.decode(errors="replace")
+    elif kind == ACT_REMOTE:
+        return kind, unpack_messages(payload)
+    else:
+        return (kind,)
+
+
+# Play a replay log again at full speed. Returns a report with the turn timings and whether the game ended the same
+def replay(path, quizzes):
+    with open(path, "rb") as replay_file:
+        snapshot, quiz_count, records = read_replay(replay_file.read())
+    if quiz_count != len(quizzes):
+        raise ValueError("the game was recorded with %d quizzes, not %d" % (quiz_count, len(quizzes)))
+
+    state = unpack_game(snapshot, quizzes)
+    turn_times = []  # Seconds spent in the engine for each turn
+    elapsed = 0
+    expected = None
+    turn = state.turns
+
+    for code, payload in records:
+        if code == REPLAY_STOP:
+            expected = payload
+            break
+
+        start_time = time.perf_counter()
+        if code == REPLAY_DISCONNECT:
+            disconnect(state)
+        else:
+            step(state, replay_action(code, payload))
+        elapsed += time.perf_counter() - start_time
+        state.outbox.clear()
+
+        if state.turns != turn or state.over:
+            turn_times.append(elapsed)
+            elapsed = 0
+            turn = state.turns
+
+    if elapsed:
+        turn_times.append(elapsed)
+    slowest = sorted(range(len(turn_times)), key=turn_times.__getitem__, reverse=True)[:REPLAY_SLOWEST]
+    return {
+        "records": len(records),
+        "turns": len(turn_times),
+        "total_ms": sum(turn_times) * 1000,
+        "per_turn": bench_stats(turn_times) if turn_times else None,
+        "slowest_turns": [{"turn": i + 1, "ms": turn_times[i] * 1000} for i in slowest],
+        "verified": None if expected is None else replay_digest(state) == bytes(expected),
+    }
+
+
+#####################################################################################################################
+#       COMMAND LINE                                                                                                #
+#####################################################################################################################
+
+EVENT_TEXTS = {
+    EV_OPP_ESCAPED: "In lontananza, senti la porta chiudersi. Ti rimangono 10 mosse, ne hai fatte: %d",
+    EV_OPP_DEAD: "Le urla strazianti di un altro avventuriero giungono alle tue orecchie.",
+    EV_STRANGER: "Di fronte a te si staglia uno sconosciuto...",
+    EV_OPP_SAYS: "Lo sconosciuto ti dice:\n%s",
+    EV_OPP_TRIPS: "Lo sconosciuto sguaina la spada.. Ma inciampa come una pera cotta",
+    EV_ROBBED: "Vieni derubato dallo sconosciuto!",
+    EV_KARMA: "Ti prepari ad attacare lo sconosciuto..\nMa il Karma punisce le tue cattive intenzioni.\n"
+              "Inciampi e perdi parte del tuo bottino.",
+    EV_COUNTERED: "Lo sconosciuto risponde all'attacco e rimani ferito",
+    EV_REPELLED: "Il tuo avversario intendeva derubarti, ma riesci a respingerlo",
+    EV_STOLE_UNAWARE: "Riesci a derubare l'ignaro sconosciuto.",
+    EV_CAUGHT: "L'avversario percepisce le tue intenzioni e ti attacca.",
+    EV_STOLE: "Riesci a derubare lo sconosciuto.",
+    EV_STALEMATE: "Nella foga di derubarvi a vicenda non concludete nulla",
+    EV_CORRIDOR: "Ti immetti nel tetro corridoio...",
+    EV_MONSTER: "Un mostro orribile ti si para davanti!",
+    EV_MONSTER_SLAIN: "Usando la tua spada riesci a distruggere il mostro!",
+    EV_MONSTER_HURT: "Riesci a sconfiggere il mostro, ma subisci dei danni",
+    EV_MONSTER_STANDS: "Colpisci il mostro, ma resiste e ti ferisce. Meglio tornare indietro!",
+    EV_MONSTER_BITES: "Mostri alle calcagna ti raggiungono e ti feriscono: %d",
+    EV_CHEST: "Trovi una cassa del tesoro davanti a te!",
+    EV_CHEST_OPEN: "Utilizzando il grimaldello riesci ad aprire la cassa",
+    EV_CHEST_LOCKED: "La cassa è chiusa e non riesci ad aprirla",
+    EV_TRAP: "Questa stanza contiene una trappola!",
+    EV_TRAP_AVOIDED: "Ti accorgi della trappola e riesci ad evitarla",
+    EV_TRAP_DISARMED: "Riesci a disinnescare la trappola col tuo coltello",
+    EV_GAS: "Una nube di gas velenoso ti avvolge",
+    EV_PIT: "Il pavimento si apre sotto ai tuoi piedi.\n"
+            "Riesci a metterti in salvo ma parte del tuo bottino cade nel fosso",
+    EV_QUIZ: "Sulla parete è riportata una misteriosa incisione...\n%s",
+    EV_QUIZ_RIGHT: "Si apre un'alcova e trovi un tesoro",
+    EV_ESCAPED_IN_TIME: "Sei fuggito in tempo!",
+    EV_UNKNOWN_ROOM: "C'è qualcosa in questa stanza, ma non riesci a capire cosa...",
+    EV_EXIT_NEARBY: "Vedi l'uscita di fronte a te!",
+    EV_TRAPPED: "Senti la porta chiudersi in lontananza, intrappolandoti per sempre...",
+    EV_DEAD: "Sei morto.",
+    EV_WIN: "Riesci finalmente a vedere la luce del giorno. Congratulazioni!",
+    EV_WALL: "Vi è un muro in quella direzione.",
+    EV_STAY: "Decidi di restare qui",
+    EV_UNKNOWN_INPUT: "Input non riconosciuto.",
+}
+ITEM_TEXTS = {  # Found / already have
+    RM_COMP: ("Trovi una bussola in questa stanza", "Ma ne hai già una.."),
+    RM_SWRD: ("Trovi una spada in questa stanza", "Ma ne hai già una.."),
+    RM_KNIFE: ("Trovi un coltello in questa stanza", "Ma ne hai già uno.."),
+    RM_LOCKP: ("Trovi un grimaldello in questa stanza", "Ma ne hai già uno.."),
+}
+MOVE_KEYS = {'w': (-1, 0), 'a': (0, -1), 's': (1, 0), 'd': (0, 1), '': (0, 0)}
+
+
+# Print the events of a step
+def show(state, events):
+    for event in events:
+        kind = event[0]
+        if kind == EV_FRAME:
+            state.dungeon.print_hidden(state.dungeon.p1, DUNGEON_SIGHT, state.player)
+        elif kind == EV_FULL_MAP:
+            state.dungeon.print()
+        elif kind == EV_COMPASS:
+            if event[2] is not None:
+                print("La bussola indica verso %s, l'uscita dista %d passi" % (event[1], event[2]))
+            else:
+                print("La bussola indica verso " + event[1])
+        elif kind == EV_FOUND:
+            print(ITEM_TEXTS[event[1]][0])
+        elif kind == EV_ALREADY_HAVE:
+            print(ITEM_TEXTS[event[1]][1])
+        elif kind == EV_CHEATS:
+            print("Trucchi abilitati!" if event[1] else "Trucchi disabilitati!")
+        elif kind == EV_SCORE:
+            opponent_gold, coin = event[1], event[2]
+            print("Il tuo avversario ha raccimolato ben " + str(opponent_gold) + " monete d'oro.")
+            print("Hai raccimolato ben " + str(coin) + " monete d'oro.")
+            print("Il tuo avversario vince!" if opponent_gold > coin else "Hai vinto!")
+        elif len(event) > 1:
+            print(EVENT_TEXTS[kind] % event[1:])
+        else:
+            print(EVENT_TEXTS[kind])
+
+
+# Lines typed by the player. Read on a separate thread once a turn timer has been used, so that reads can time out
+typed = None
+
+
+def read_lines():
+    try:
+        while True:
+            typed.put(input())
+    except EOFError:
+        pass
+
+
+# Read a line like input(). If timed, in multiplayer and with a TURN_TIMER, return None when the timer runs out
+def read_line(prompt="", timed=False):
+    global typed
+    if typed is None and (not timed or TURN_TIMER is None):
+        return input(prompt)
+
+    if typed is None:
+        typed = queue.Queue()
+        threading.Thread(target=read_lines, daemon=True).start()
+    print(prompt, end="", flush=True)
+    if not timed or TURN_TIMER is None:
+        return typed.get()
+
+    # Lines typed after the last timer ran out were meant for a turn that's gone
+    while not typed.empty():
+        typed.get_nowait()
+    try:
+        return typed.get(timeout=TURN_TIMER)
+    except queue.Empty:
+        print("Tempo scaduto!")
+        return None
+
+
+# Get input from player and turn it into a move or cheat action. Cheats can be input here as well.
+# Master code: JUSTINBAILEY
+def read_move(state, conn):
+    print("Dove desideri andare? (Tasti WASD per muoversi, 'save' per salvare, 'quit' per uscire)")
+    if state.multi and TURN_TIMER is not None:
+        print("Hai %g secondi, poi resterai dove sei" % TURN_TIMER)
+    pl_input = read_line(timed=state.multi)
+
+    if pl_input is None:    # Missed the turn
+        return ACT_MOVE, 0, 0
+    elif pl_input in MOVE_KEYS:
+        return (ACT_MOVE,) + MOVE_KEYS[pl_input]
+    elif pl_input == "save":    # Handled here, not a game action
+        if state.multi or not isinstance(state.dungeon, DungeonGraph):
+            print("Puoi salvare solo le partite in solo")
+        else:
+            save_game(state)
+            print("Partita salvata. Per riprenderla: python cheap-dungeons.py --resume")
+        return None
+    elif pl_input == "quit":
+        if conn is not None:
+            conn.close()
+        exit()
+    else:
+        return ACT_CHEAT, pl_input
+
+
+# Ask the player what to do with the stranger, or None if the input isn't a choice
+def read_encounter(player, timed):
+    print("Cosa desideri fare?")
+    print("s - Saluta lo sconosciuto")
+    if player.has_sword:
+        print("a - Attacca lo sconosciuto")
+    if player.has_knife:
+        print("r - Deruba lo sconosciuto")
+    choice = read_line(timed=timed)
+
+    if choice is None:  # Out of time: keep quiet
+        return ACT_GREET, ""
+    elif choice == "s":
+        print("Cosa vuoi dire allo sconosciuto?")
+        return ACT_GREET, read_line(timed=timed) or ""
+    elif choice == "a":
+        return (ACT_ATTACK,)
+    elif choice == "r":
+        return (ACT_STEAL,)
+    else:
+        print("Input non riconosciuto.")
+        return None
+
+
+# Ask the player for the action the state is waiting for. Returns None if there's nothing valid to do yet
+def read_action(state, conn):
+    if state.waiting == WAIT_ANSWER:
+        return ACT_ANSWER, read_line(timed=state.multi) or ""
+    elif state.waiting == WAIT_ENCOUNTER:
+        return read_encounter(state.player, state.multi)
+    elif state.turnback:
+        read_line("Decidi di tornare indietro... (premi un tasto)", state.multi)
+        return ACT_MOVE, 0, 0
+    else:
+        return read_move(state, conn)
+
+
+# Ask for the game mode and set the game up. Returns the state, its first events and the opponent connection if any
+def new_game():
+    print("Vuoi giocare in solo, con un amico o in un dungeon senza fine? s/a/i")
+    mode = input()
+    multi = mode == "a"
+
+    dungeon = None
 
     conn = None
 
@@ -469,7 +2553,8 @@ def play():
 
         if type_mod == "c":
             conn = sck.socket(sck.AF_INET, sck.SOCK_STREAM)
-            print("Immetti l'indirizzo ip del tuo avversario (assicurati che il tuo avversario sia in attesa)")
+            print("Immetti l'indirizzo ip del tuo avversario o del server "
+                  "(assicurati che il tuo avversario sia in attesa)")
             ip_player = input()
             print("In attesa dell'avversario...")
 
@@ -479,34 +2564,19 @@ def play():
                 print("Indirizzo IP non valido oppure l'avversario non ha iniziato una partita")
                 exit()
 
-            msg = "DUNGEON"
-
             try:
-                for i in range(DUNGEON_SIZE):   # Receive map row by row
-                    conn.sendall(msg.encode())
-                    dungeon.data[i] = list(conn.recv(1024).decode())
-                    print("Ricezione mappa : " + str(float(i) / DUNGEON_SIZE * 100) + "%                ", end='\r')
-
-                print("Riceziona mappa completata")
-
-                # Receive P1 and P2
-                pos_string = conn.recv(1024).decode()
-                pos_p1 = pos_string.split(',')
-
-                conn.sendall(msg.encode())
-                pos_string = conn.recv(1024).decode()
-                pos_p2 = pos_string.split(',')
-
-                dungeon.p2 = int(pos_p1[0]), int(pos_p1[1])  # Positions are swapped because this is the second player
-                dungeon.p1 = int(pos_p2[0]), int(pos_p2[1])
+                dungeon = receive_dungeon(conn)  # The host sends the seed, or the whole map as a fallback
+                print("Ricezione mappa completata")
 
-            except ConnectionAbortedError:
+            except (ConnectionAbortedError, ValueError):
                 print("Connessione interrotta dall'avversario")
                 multi = False
-                dungeon.p2 = None
                 conn.close()
+                dungeon = DungeonGraph(False)
 
         else:
+            dungeons.warm(True)  # Generated while waiting for the opponent
+
             print("In attesa dell'avversario...")
             c = sck.socket(sck.AF_INET, sck.SOCK_STREAM)  # Connection setup
             c.bind(("", MULTI_PORT))
@@ -514,384 +2584,1156 @@ def play():
             conn, _ = c.accept()
             c.close()
 
-            try:
-                for i in range(DUNGEON_SIZE):   # Send map row by row
-                    msg = conn.recv(1024).decode()
-                    if msg == "DUNGEON":
-                        conn.sendall(''.join(dungeon.data[i]).encode())
-                        print("Invio mappa : " + str(float(i) / DUNGEON_SIZE * 100) + "%                  ", end='\r')
+            dungeon = dungeons.take(True) or DungeonGraph(True)
 
+            try:
+                send_dungeon(conn, dungeon)
                 print("Invio mappa completato")
 
-                pos_string_p1 = str(dungeon.p1[0]) + ',' + str(dungeon.p1[1])
-                pos_string_p2 = str(dungeon.p2[0]) + ',' + str(dungeon.p2[1])
-
-                conn.sendall(pos_string_p1.encode())
-                received = conn.recv(1024).decode()
-
-                if received == "DUNGEON":
-                    conn.sendall(pos_string_p2.encode())
-
             except ConnectionAbortedError:
                 print("Connessione interrotta dall'avversario")
                 multi = False
                 dungeon.p2 = None
                 conn.close()
+    elif mode == "i":
+        dungeon = EndlessDungeon()
+    else:
+        dungeons.warm(False)  # Generated while the player types their name
 
     print("Senza ricordare il perché, ti ritrovi in un luogo a te non familiare...")
     print("Qual è il tuo nome?")
 
-    player.name = input()
+    name = input()
+
+    if dungeon is None:
+        dungeon = dungeons.take(False) or DungeonGraph(False)
+    player = EndlessPlayer(dungeon) if mode == "i" else Player(dungeon.size)
+    player.name = name
 
-    # Some initialization
-    msg_queue = []
-    previous_tile = curr_tile = dungeon.p1
-    escaped = False
-    opponent_escaped = False
-    opponent_dead = False
-    wait_opponent = False
-    movs_to_esc = 0
-    opponent_gold = -1
-    turnback = False
+    state, events = start(GameState(dungeon, player, QuizBank("quiz.txt"), multi))
+    return state, events, conn
 
-    with open("quiz.txt") as quiz_file:
-        quizzes = [quiz.strip().split('-') for quiz in quiz_file.readlines()]
+
+# Play from the command line. With resume, go on with the game saved in that file. With record, write its replay log
+def play(resume=None, record=None):
+    print("  _______ _________   ___    ___  __  ___  _______________  _  ______")
+    print(" / ___/ // / __/ _ | / _ \  / _ \/ / / / |/ / ___/ __/ __ \/ |/ / __/")
+    print("/ /__/ _  / _// __ |/ ___/ / // / /_/ /    / (_ / _// /_/ /    /\ \  ")
+    print("\___/_//_/___/_/ |_/_/    /____/\____/_/|_/\___/___/\____/_/|_/___/  ")
+    print()
+    print("Benvenuto a Cheap Dungeons!")
+
+    if resume is not None:
+        state, events, conn = load_game(resume, QuizBank("quiz.txt")), [(EV_FRAME,)], None
+        print("Bentornato, %s. Ricordi dov'eri rimasto..." % state.player.name)
+    else:
+        state, events, conn = new_game()
+        dungeons.close()  # One game per run: nothing left to generate for
+    show(state, events)
+
+    recorder = None
+    if record is not None:
+        try:
+            recorder = ReplayRecorder(record, state)
+        except ValueError:
+            print("Questa partita non può essere registrata")
 
     # GAME LOOP #
-    while not escaped:
-        room, curr_tile, exit_found = update(curr_tile, player, dungeon)
-        msg_queue.clear()
-
-        if opponent_escaped:
-            print("In lontananza, senti la porta chiudersi. Ti rimangono 10 mosse, ne hai fatte: " + str(movs_to_esc))
-        elif opponent_dead:
-            print("Le urla strazianti di un altro avventuriero giungono alle tue orecchie.")
-            opponent_dead = False
-
-        if player.has_compass:
-            direction = "Ovest"
-            for i in range(7):
-                max_ang = math.pi * (7 - 2*i) / 8
-                min_ang = math.pi * (5 - 2*i) / 8
-                ang = math.atan2(dungeon.p1[0] - dungeon.exit[0], dungeon.exit[1] - dungeon.p1[1])
-                if min_ang < ang <= max_ang:
-                    direction = DIRECTIONS[i]
-                    break
+    while not state.over:
+        action = None
+
+        try:
+            if state.outbox:    # Sending the finished turn or encounter stage
+                for messages in state.outbox:
+                    send_messages(conn, messages)
+                state.outbox.clear()
+                if state.waiting == WAIT_REMOTE and state.encounter is None:
+                    print("Attendi la mossa del tuo avversario...")
+
+            if state.waiting == WAIT_REMOTE:    # Receiving opponent data
+                action = ACT_REMOTE, recv_messages(conn)
+
+        except (ConnectionError, ValueError):
+            print("Connessione chiusa da parte dell'avversario")
+            if recorder is not None:
+                recorder.disconnect()
+            show(state, disconnect(state))
+
+        if not state.multi and conn is not None:
+            conn.close()
+            conn = None
+
+        if action is None and not state.over:
+            action = read_action(state, conn)
+
+        if action is not None:
+            if recorder is not None:
+                recorder.action(action)
+            show(*step(state, action))
 
-            print("La bussola indica verso " + direction)
+    # END GAME LOOP #
 
-        # Player encounter cases
-        if dungeon.p1 == dungeon.p2:
-            turnback = True
+    if recorder is not None:
+        recorder.close(state)
 
-            print("Di fronte a te si staglia uno sconosciuto...")
-            print("Cosa desideri fare?")
-            print("s - Saluta lo sconosciuto")
-            if player.has_sword:
-                print("a - Attacca lo sconosciuto")
-            if player.has_knife:
-                print("r - Deruba lo sconosciuto")
-            choice = input()
+    if conn is not None:
+        try:
+            for messages in state.outbox:  # The last turn, which an opponent still playing waits on
+                send_messages(conn, messages)
+        except ConnectionError:
+            pass
+        conn.close()
+
+    read_line("Premi un tasto per uscire...")
 
+
+#####################################################################################################################
+#       MATCH SERVER                                                                                                #
+#####################################################################################################################
+#   A standalone server for many concurrent multiplayer matches. Clients connect to it the same way they would      #
+#   connect to a hosting friend. Waiting clients are paired two by two in the lobby, then the server plays the host #
+#   side of the handshake with both and relays every frame to the other player, keeping track of the match state    #
+#   along the way. Each match runs in its own task, so a slow or idle client only stalls its own match. Spectators  #
+#   connect to SPECTATOR_PORT and watch the latest match, or the next one, arenas included. They get the whole map  #
+#   as a HS_MAP handshake, preceded by a MSG_SNAP frame, then one frame per relayed one with its MSG_POS, MSG_CLR,  #
+#   MSG_DIE and MSG_ESC messages behind a MSG_SEAT. Spectators are written to without ever waiting: one that falls  #
+#   behind by SPECTATOR_BUFFER is skipped until it has received everything, then sent the map again to catch up, or #
+#   dropped if that takes longer than IDLE_TIMEOUT.                                                                 #
+#####################################################################################################################
+
+SPECTATOR_MSGS = (MSG_POS, MSG_CLR, MSG_MNST, MSG_DIE, MSG_ESC)  # What spectators are sent of the relayed messages
+ARENA_NOWHERE = 0xFFFF, 0xFFFF  # Stranger position sent when there's no one else to show
+
+
+# A match spectators can watch. Subclasses hold the dungeon and give the status of each seat.
+class Watched:
+    def __init__(self, dungeon):
+        self.dungeon = dungeon
+        self.spectators = {}  # Writer -> None, or the time it fell behind
+
+    # (seat, messages) couples to bring a new spectator up to date after the map
+    def status(self):
+        return []
+
+    # The whole match state for a spectator: the map, then the status of the seats
+    def snapshot(self):
+        status = [msg for seat, messages in self.status() for msg in [(MSG_SEAT, seat)] + messages]
+        snap = pack_messages([(MSG_SNAP,)])
+        frame = FRAME_HEAD.pack(len(snap)) + snap + handshake_head(self.dungeon, HS_MAP, True) + self.dungeon.data
+        if status:
+            payload = pack_messages(status)
+            frame += FRAME_HEAD.pack(len(payload)) + payload
+        return frame
+
+    def watch(self, writer):
+        writer.write(self.snapshot())
+        self.spectators[writer] = None
+
+    # Pass the messages of a seat on to the spectators, without waiting for any of them
+    def broadcast(self, seat, messages):
+        updates = [msg for msg in messages if msg[0] in SPECTATOR_MSGS]
+        if not updates or not self.spectators:
+            return
+        payload = pack_messages([(MSG_SEAT, seat)] + updates)
+        frame = FRAME_HEAD.pack(len(payload)) + payload
+        limit = SPECTATOR_BUFFER + len(self.dungeon.data)
+        now = time.monotonic()
+
+        for writer, behind in list(self.spectators.items()):
+            if writer.is_closing():
+                del self.spectators[writer]
+                continue
+            unsent = writer.transport.get_write_buffer_size()
+            if behind is None and unsent > limit:
+                self.spectators[writer] = now  # Stop sending updates until it catches up
+            elif behind is None:
+                writer.write(frame)
+            elif unsent == 0:
+                self.watch(writer)  # Every update was skipped: start over from the current state
+            elif now - behind > IDLE_TIMEOUT:
+                writer.close()
+                del self.spectators[writer]
+
+    def close(self):
+        for writer in self.spectators:
+            writer.close()
+        self.spectators.clear()
+
+
+# One two-player match hosted by the server. Seat 0 plays as the dungeon P1, seat 1 as P2.
+class Match(Watched):
+    def __init__(self, dungeon):
+        super().__init__(dungeon)
+        self.players = (Player(dungeon.size), Player(dungeon.size))
+        self.escaped = [False, False]
+
+    # Who died or escaped
+    def status(self):
+        status = []
+        for seat in (0, 1):
+            if self.players[seat].health == 0:
+                status.append((seat, [(MSG_DIE,)]))
+            elif self.escaped[seat]:
+                status.append((seat, [(MSG_ESC, self.players[seat].coin)]))
+        return status
+
+    # Update the server copy of the match with the messages sent by the given seat
+    def apply(self, seat, messages):
+        for msg in messages:
+            if msg[0] == MSG_POS:
+                if seat == 0:
+                    self.dungeon.p1 = msg[1], msg[2]
+                else:
+                    self.dungeon.p2 = msg[1], msg[2]
+            elif msg[0] == MSG_CLR:
+                self.dungeon.set((msg[1], msg[2]), RM_EMPTY)
+            elif msg[0] == MSG_HIT:
+                self.dungeon.entities.hp[msg[1] * self.dungeon.size + msg[2]] = msg[3]
+            elif msg[0] == MSG_MNST:
+                walk_in(self.dungeon, (msg[1], msg[2]), msg[3])
+            elif msg[0] == MSG_ESC:
+                self.escaped[seat] = True
+                self.players[seat].coin = msg[1]
+            elif msg[0] == MSG_DIE:
+                self.players[seat].health = 0
+
+
+# Grid hash of player positions: seats by room, and by square buckets of bucket rooms per side for the nearby ones
+class PlayerGrid:
+    def __init__(self, size, bucket=DUNGEON_SIGHT):
+        self.bucket = bucket
+        self.rings = size // bucket + 1  # Enough rings of buckets around any room to cover the whole grid
+        self.positions = {}  # Seat -> position
+        self.rooms = {}  # Position -> set of seats
+        self.buckets = {}  # (x // bucket, y // bucket) -> set of seats
+
+    def move(self, seat, pos):
+        self.remove(seat)
+        self.positions[seat] = pos
+        self.rooms.setdefault(pos, set()).add(seat)
+        self.buckets.setdefault((pos[0] // self.bucket, pos[1] // self.bucket), set()).add(seat)
+
+    def remove(self, seat):
+        pos = self.positions.pop(seat, None)
+        if pos is not None:
+            for index, key in ((self.rooms, pos), (self.buckets, (pos[0] // self.bucket, pos[1] // self.bucket))):
+                index[key].discard(seat)
+                if not index[key]:
+                    del index[key]
+
+    # Seats in the given room
+    def at(self, pos):
+        return self.rooms.get(pos, set())
+
+    # The closest seat to pos (taxicab distance, lowest seat on ties) not in excluded, or None. Looks at the buckets
+    # in rings around pos, up to radius rooms away if given, and stops once farther rings can't hold a closer seat
+    def nearest(self, pos, excluded=(), radius=None):
+        bx, by = pos[0] // self.bucket, pos[1] // self.bucket
+        rings = self.rings if radius is None else radius // self.bucket + 1
+        best = None
+
+        for ring in range(rings + 1):
+            if best is not None and best[0] <= (ring - 1) * self.bucket:
+                break
+            for x in range(bx - ring, bx + ring + 1):
+                step = 1 if abs(x - bx) == ring else 2 * ring  # Whole rows at the top and bottom, sides in between
+                for y in range(by - ring, by + ring + 1, max(step, 1)):
+                    for seat in self.buckets.get((x, y), ()):
+                        dst = tpl_dst(pos, self.positions[seat])
+                        if seat not in excluded and (radius is None or dst <= radius) and \
+                                (best is None or (dst, seat) < best):
+                            best = dst, seat
+
+        return None if best is None else best[1]
+
+    # Seats at most radius rooms from pos on both axes, as in a sight window, in no particular order
+    def within(self, pos, radius):
+        seats = []
+        for bx in range((pos[0] - radius) // self.bucket, (pos[0] + radius) // self.bucket + 1):
+            for by in range((pos[1] - radius) // self.bucket, (pos[1] + radius) // self.bucket + 1):
+                for seat in self.buckets.get((bx, by), ()):
+                    x, y = self.positions[seat]
+                    if abs(x - pos[0]) <= radius and abs(y - pos[1]) <= radius:
+                        seats.append(seat)
+        return seats
+
+
+# A match of more than two players, in lockstep. The players still play two player games: the server collects the turns
+# of all of them, then sends each one a frame with every cleared room and hurt or moved monster and the position of a
+# single stranger: whoever shares its room if anyone (the two of them then meet, and their encounter frames are relayed
+# between them), or else the closest player, within sight if possible. Every other player within the DUNGEON_SIGHT
+# window is sent as a MSG_NEAR, to be drawn on the map. Once someone escapes everyone else is told, and the rest of the
+# match goes on without waiting, like the last moves of a two player one. Escaped players get the best score among the
+# others who escaped, or are told they all died, once no one is left. Spectators are sent the position of every seat,
+# and MSG_DIE for the ones who left.
+class Arena(Watched):
+    def __init__(self, dungeon):
+        super().__init__(dungeon)
+        self.grid = PlayerGrid(dungeon.size)
+        for seat, pos in enumerate(dungeon.spawns):
+            self.grid.move(seat, pos)
+        self.playing = set(range(len(dungeon.spawns)))  # Seats still in the dungeon
+        self.turns = {}  # Seat -> its turn messages, until everyone has played
+        self.partners = {}  # Seat -> the seat it's meeting
+        self.escaped = {}  # Seat -> coins it got out with
+        self.lockstep = True  # Until someone escapes
+
+    # Where every seat is, for spectators: escaped or out of the dungeon if not playing
+    def status(self):
+        status = []
+        for seat in range(len(self.dungeon.spawns)):
+            if seat in self.playing:
+                status.append((seat, [(MSG_POS,) + self.grid.positions[seat]]))
+            elif seat in self.escaped:
+                status.append((seat, [(MSG_ESC, self.escaped[seat])]))
+            else:
+                status.append((seat, [(MSG_DIE,)]))
+        return status
+
+    # Map mode handshake for a seat, with the closest other player as the stranger
+    def handshake(self, seat):
+        dungeon, own = self.dungeon, self.dungeon.spawns[seat]
+        other = self.grid.positions[self.grid.nearest(own, {seat})]
+        return HANDSHAKE_HEAD.pack(HS_MAP, dungeon.seed, dungeon.size, *other, *own, *dungeon.exit,
+                                   *handshake_rules(), zlib.crc32(dungeon.data)) + dungeon.data
+
+    # Handle the messages of a seat. Returns the (seat, messages) to send out, messages being None to drop the seat
+    def receive(self, seat, messages):
+        if not any(msg[0] in (MSG_POS, MSG_DIE, MSG_ESC) for msg in messages):
+            partner = self.partners.get(seat)  # Encounter frame
+            return [(partner, messages)] if partner in self.playing else []
+
+        self.partners.pop(seat, None)
+        if not self.lockstep:
+            self.apply(seat, messages)
+            return self.finish()
+
+        self.turns[seat] = messages
+        return self.resolve() if self.playing <= self.turns.keys() else []
+
+    # The seat left: out of the match. Its partner, if it was meeting it, can't go on either
+    def leave(self, seat):
+        out = []
+        partner = self.partners.pop(seat, None)
+        if seat in self.playing:
+            self.broadcast(seat, [(MSG_DIE,)])
+            self.playing.discard(seat)
+            self.grid.remove(seat)
+            self.turns.pop(seat, None)
+            if partner is not None and self.partners.pop(partner, None) == seat:
+                out.append((partner, None))
+        if self.lockstep and self.playing and self.playing <= self.turns.keys():
+            out += self.resolve()
+        return out + self.finish()
+
+    # Update the match with the turn of a seat. Returns its cleared rooms and hurt or moved monsters, for the others.
+    # Players only know the stranger they're shown, so two of them may move the same hunting monster (see hunt): the
+    # move of a monster that's no longer there is dropped, and everyone is told what the room it went to holds instead
+    def apply(self, seat, messages):
+        rooms = []
+        gone = False  # Whether the last room cleared had no monster, on the server copy
+        for msg in messages:
+            if msg[0] == MSG_POS:
+                self.grid.move(seat, (msg[1], msg[2]))
+            elif msg[0] == MSG_CLR:
+                gone = self.dungeon.get((msg[1], msg[2])) != RM_MNST
+                self.dungeon.set((msg[1], msg[2]), RM_EMPTY)
+                rooms.append(msg)
+            elif msg[0] == MSG_HIT:
+                self.dungeon.entities.hp[msg[1] * self.dungeon.size + msg[2]] = msg[3]
+                rooms.append(msg)
+            elif msg[0] == MSG_MNST and gone:  # Moved from the room cleared just before, by someone else already
+                pos = msg[1], msg[2]
+                if self.dungeon.get(pos) == RM_MNST:
+                    store, idx = self.dungeon.entity(pos)
+                    rooms.append((MSG_MNST,) + pos + (store.hp[idx],))
+                else:
+                    rooms.append((MSG_CLR,) + pos)
+            elif msg[0] == MSG_MNST:
+                walk_in(self.dungeon, (msg[1], msg[2]), msg[3])
+                rooms.append(msg)
+            elif msg[0] == MSG_ESC:
+                self.escaped[seat] = msg[1]
+                self.playing.discard(seat)
+            elif msg[0] == MSG_DIE:
+                self.playing.discard(seat)
+        if seat not in self.playing:
+            self.grid.remove(seat)
+        self.broadcast(seat, [msg for msg in messages if msg[0] in (MSG_POS, MSG_DIE, MSG_ESC)] + rooms)
+        return rooms
+
+    # Everyone played: apply the turns in seat order and tell each player what it sees
+    def resolve(self):
+        clears = []
+        for seat in sorted(self.turns):
+            clears += self.apply(seat, self.turns[seat])
+        # Whoever died still waits on this turn to end its game
+        out = [(seat, list(clears)) for seat in sorted(self.turns) if seat not in self.playing | self.escaped.keys()]
+        self.turns.clear()
+
+        if self.escaped:
+            self.lockstep = False
+        for seat in sorted(self.playing):
+            pos = self.grid.positions[seat]
+            view = list(clears)
+            if seat not in self.partners:
+                met = self.grid.at(pos) - {seat} - self.partners.keys()
+                if met:
+                    partner = min(met)
+                    self.partners[seat], self.partners[partner] = partner, seat
+            if seat in self.partners:
+                shown = self.partners[seat]
+                view.append((MSG_POS,) + pos)
+            else:
+                crowd = self.grid.at(pos)  # Players met by someone else can't be shown in the same room
+                shown = self.grid.nearest(pos, crowd, DUNGEON_SIGHT)
+                if shown is None:
+                    shown = self.grid.nearest(pos, crowd)
+                view.append((MSG_POS,) + (ARENA_NOWHERE if shown is None else self.grid.positions[shown]))
+            view += [(MSG_NEAR,) + self.grid.positions[other]
+                     for other in sorted(self.grid.within(pos, DUNGEON_SIGHT)) if other not in (seat, shown)]
+
+            if self.escaped:
+                view.append((MSG_ESC, max(self.escaped.values())))  # A few moves left
+            elif len(self.playing) == 1:
+                view.append((MSG_DIE,))  # Last one standing: goes on alone
+                self.playing.clear()
+            out.append((seat, view))
+        return out + self.finish()
+
+    # Once no one is playing, tell the players who escaped first how the others did
+    def finish(self):
+        if self.playing or self.lockstep:
+            return []
+        out = []
+        for seat in self.escaped:
+            others = [coins for other, coins in self.escaped.items() if other != seat]
+            out.append((seat, [(MSG_ESC, max(others))] if others else [(MSG_DIE,)]))
+        self.escaped.clear()
+        return out
+
+
+class MatchServer:
+    def __init__(self, size=DUNGEON_SIZE, players=2):
+        self.size = size
+        self.players = players  # Per match
+        self.lobby = []  # Waiting clients as (reader, writer, watcher task) tuples
+        self.matches = set()  # Running match tasks
+        self.running = []  # Matches spectators can watch, oldest first
+        self.audience = []  # Spectators waiting for a match to start
+
+    async def handle_client(self, reader, writer):
+        # Nothing is expected from a waiting client, so a finished read means it left the lobby
+        watcher = asyncio.ensure_future(reader.read(1))
+        waiting = (reader, writer, watcher)
+        watcher.add_done_callback(lambda _: self.leave_lobby(waiting))
+        self.lobby.append(waiting)
+
+        if len(self.lobby) >= self.players:
+            seats = self.lobby[:self.players]
+            del self.lobby[:self.players]
+            for _, _, w in seats:
+                w.cancel()
+            if self.players == 2:
+                task = asyncio.ensure_future(self.run_match(seats[0][:2], seats[1][:2]))
+            else:
+                task = asyncio.ensure_future(self.run_arena([seat[:2] for seat in seats]))
+            self.matches.add(task)
+            task.add_done_callback(self.matches.discard)
+
+    # Spectators watch the latest match. They don't send anything
+    async def handle_spectator(self, reader, writer):
+        if self.running:
+            self.running[-1].watch(writer)
+        else:
+            self.audience.append(writer)
+
+    def leave_lobby(self, waiting):
+        if waiting in self.lobby and not waiting[2].cancelled():
+            self.lobby.remove(waiting)
+            waiting[1].close()
+
+    async def run_match(self, seat0, seat1):
+        seats = (seat0, seat1)
+        match = None
+        try:
+            # Take a pooled dungeon, or generate it on a worker thread so it doesn't hold up the other matches
+            dungeon = dungeons.take(True, self.size) or \
+                await asyncio.get_running_loop().run_in_executor(None, DungeonGraph, True, self.size)
+            match = Match(dungeon)
+            print("Partita avviata (%d in corso)" % len(self.matches))
+
+            await asyncio.gather(*(self.send_dungeon(r, w, dungeon, seat == 0) for seat, (r, w) in enumerate(seats)))
+
+            self.show(match)
+
+            # Relay until a player leaves. Remaining frames are flushed by close()
+            relays = [asyncio.ensure_future(self.relay(match, seat, seats[seat][0], seats[1 - seat][1]))
+                      for seat in (0, 1)]
+            _, pending = await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            for _, writer in seats:
+                writer.close()
+            self.hide(match)
+            print("Partita conclusa (%d in corso)" % (len(self.matches) - 1))
+
+    async def run_arena(self, seats):
+        arena = None
+        try:
+            dungeon = dungeons.take(True, self.size, len(seats)) or \
+                await asyncio.get_running_loop().run_in_executor(None, DungeonGraph, True, self.size, None, True,
+                                                                 len(seats))
+            arena = Arena(dungeon)
+            print("Partita a %d giocatori avviata (%d in corso)" % (len(seats), len(self.matches)))
+
+            for seat, (_, writer) in enumerate(seats):
+                writer.write(arena.handshake(seat))
+            await asyncio.gather(*(asyncio.wait_for(writer.drain(), IDLE_TIMEOUT) for _, writer in seats))
+            self.show(arena)
+
+            # Every player plays until it leaves: the match is over when they all have
+            await asyncio.gather(*(self.arena_relay(arena, seat, seats) for seat in range(len(seats))))
+
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            for _, writer in seats:
+                writer.close()
+            self.hide(arena)
+            print("Partita conclusa (%d in corso)" % (len(self.matches) - 1))
+
+    # Let spectators watch the match, starting with those waiting for one
+    def show(self, match):
+        self.running.append(match)
+        for writer in self.audience:
+            if not writer.is_closing():
+                match.watch(writer)
+        self.audience.clear()
+
+    # The match is over: its spectators are let go
+    def hide(self, match):
+        if match in self.running:
+            self.running.remove(match)
+            match.close()
+
+    # Pass every frame of a seat to the arena and send out what it answers, until the connection drops or goes idle
+    @staticmethod
+    async def arena_relay(arena, seat, seats):
+        reader = seats[seat][0]
+        try:
+            while True:
+                head = await asyncio.wait_for(reader.readexactly(FRAME_HEAD.size), IDLE_TIMEOUT)
+                length, = FRAME_HEAD.unpack(head)
+                if length > MAX_FRAME_SIZE:
+                    break
+                payload = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT)
+                await MatchServer.arena_send(seats, arena.receive(seat, unpack_messages(payload)))
+
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            seats[seat][1].close()
+            await MatchServer.arena_send(seats, arena.leave(seat))
+
+    @staticmethod
+    async def arena_send(seats, out):
+        writers = set()
+        for seat, messages in out:
+            writer = seats[seat][1]
+            if messages is None:
+                writer.close()
+            elif not writer.is_closing():
+                payload = pack_messages(messages)
+                writer.write(FRAME_HEAD.pack(len(payload)) + payload)
+                writers.add(writer)
+        for writer in writers:
             try:
-                # Handle "Greet" cases
-                if choice == "s":
-                    print("Cosa vuoi dire allo sconosciuto?")
-                    msg = input()
-
-                    conn.sendall(("S:" + msg).encode())
-                    opp_choice = conn.recv(1024).decode().split(":", 1)
-
-                    if opp_choice[0] == "S":
-                        print("Lo sconosciuto ti dice:")
-                        print(opp_choice[1])
-
-                    elif opp_choice[0] == "A":
-                        print("Lo sconosciuto sguaina la spada.. Ma inciampa come una pera cotta")
-
-                    elif opp_choice[0] == "R":
-                        print("Vieni derubato dallo sconosciuto!")
-                        coin_lost = int(player.coin * 0.25)
-                        player.coin -= coin_lost
-                        conn.sendall(str(coin_lost).encode())
-
-                # Handle "Attack" cases
-                elif choice == "a" and player.has_sword:
-                    conn.sendall("A:".encode())
-                    opp_choice = conn.recv(1024).decode().split(":", 1)
-
-                    if opp_choice[0] == "S":
-                        print("Ti prepari ad attacare lo sconosciuto..")
-                        print("Ma il Karma punisce le tue cattive intenzioni.")
-                        print("Inciampi e perdi parte del tuo bottino.")
-                        player.coin = int(player.coin * 0.75)
-
-                    elif opp_choice[0] == "A":
-                        print("Lo sconosciuto risponde all'attacco e rimani ferito")
-                        player.attacked(1)
-
-                    elif opp_choice[0] == "R":
-                        print("Il tuo avversario intendeva derubarti, ma riesci a respingerlo")
-
-                # Handle "Steal" cases
-                elif choice == "r" and player.has_knife:
-                    conn.sendall("R:".encode())
-                    opp_choice = conn.recv(1024).decode().split(":", 1)
-
-                    if opp_choice[0] == "S":
-                        print("Riesci a derubare l'ignaro sconosciuto.")
-                        player.coin += int(conn.recv(1024).decode())
-
-                    elif opp_choice[0] == "A":
-                        print("L'avversario percepisce le tue intenzioni e ti attacca.")
-                        player.attacked(2)
-
-                    elif opp_choice[0] == "R":
-                        luck = random.randrange(1, 1000)
-                        conn.send(str(luck).encode())
-                        opp_luck = int(conn.recv(1024).decode())
-
-                        if luck < opp_luck:
-                            print("Vieni derubato dallo sconosciuto!")
-                            coin_lost = int(player.coin * 0.25)
-                            player.coin -= coin_lost
-                            conn.sendall(str(coin_lost).encode())
-
-                        elif luck > opp_luck:
-                            print("Riesci a derubare lo sconosciuto.")
-                            player.coin += int(conn.recv(1024).decode())
-
-                        else:
-                            print("Nella foga di derubarvi a vicenda non concludete nulla")
+                await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+            except (ConnectionError, asyncio.TimeoutError):
+                writer.close()
+
+    # Async counterpart of send_dungeon
+    @staticmethod
+    async def send_dungeon(reader, writer, dungeon, swap):
+        mode = HS_SEED if SEED_HANDSHAKE and dungeon.layout == SEED_LAYOUT else HS_MAP
+        writer.write(handshake_head(dungeon, mode, swap))
+        await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+
+        if mode == HS_MAP or await asyncio.wait_for(reader.readexactly(len(HS_OK)), IDLE_TIMEOUT) != HS_OK:
+            writer.write(dungeon.data)
+            await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+
+    # Forward every frame of a seat to the other player until the connection drops or goes idle
+    @staticmethod
+    async def relay(match, seat, reader, writer):
+        try:
+            while True:
+                head = await asyncio.wait_for(reader.readexactly(FRAME_HEAD.size), IDLE_TIMEOUT)
+                length, = FRAME_HEAD.unpack(head)
+                if length > MAX_FRAME_SIZE:
+                    break
+                payload = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT)
+                messages = unpack_messages(payload)
+                match.apply(seat, messages)
+
+                writer.write(head + payload)
+                match.broadcast(seat, messages)
+                await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+
+
+# Run the match server until interrupted
+def serve(port=MULTI_PORT, size=DUNGEON_SIZE, spectator_port=SPECTATOR_PORT, players=2):
+    async def run():
+        server = MatchServer(size, players)
+        dungeons.warm(True, size, players)
+        listener = await asyncio.start_server(server.handle_client, "", port)
+        spectators = await asyncio.start_server(server.handle_spectator, "", spectator_port)
+        print("Server in ascolto sulla porta %d, spettatori sulla porta %d" % (port, spectator_port))
+        async with listener, spectators:
+            await asyncio.gather(listener.serve_forever(), spectators.serve_forever())
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Server arrestato")
+    finally:
+        dungeons.close()
+
+
+# Watch the matches of a server, with the whole map in sight. Seat 0 is drawn as P1, everyone else as P2
+def watch(host, port=SPECTATOR_PORT):
+    conn = sck.create_connection((host, port))
+    dungeon = None
+    positions = {}  # Seat -> position, while in the dungeon
+    print("In attesa di una partita...")
+
+    try:
+        while True:
+            news = []
+            seat = 0
+            for msg in recv_messages(conn):
+                if msg[0] == MSG_SNAP:
+                    dungeon = receive_dungeon(conn)
+                    positions = {0: dungeon.p1, 1: dungeon.p2}
+                elif msg[0] == MSG_SEAT:
+                    seat = msg[1]
+                elif msg[0] == MSG_POS:
+                    positions[seat] = msg[1], msg[2]
+                elif msg[0] == MSG_CLR:
+                    dungeon.set((msg[1], msg[2]), RM_EMPTY)
+                elif msg[0] == MSG_MNST:
+                    dungeon.set((msg[1], msg[2]), RM_MNST)
+                elif msg[0] == MSG_DIE:
+                    positions.pop(seat, None)
+                    news.append("Il giocatore %d è morto" % (seat + 1))
+                elif msg[0] == MSG_ESC:
+                    positions.pop(seat, None)
+                    news.append("Il giocatore %d è fuggito con %d monete" % (seat + 1, msg[1]))
+            dungeon.p1, dungeon.p2 = positions.get(0), positions.get(1)
+            dungeon.others = [pos for other, pos in positions.items() if other > 1]
+            dungeon.print()
+            for line in news:
+                print(line)
+
+    except (ConnectionError, ValueError):
+        print("Partita conclusa")
+    finally:
+        conn.close()
 
-            except ConnectionAbortedError:
-                print("L'avversario ha interrotto la connessione")
-                multi = False
-                dungeon.p2 = None
-                conn.close()
 
-        elif room == RM_EMPTY:
-            print("Ti immetti nel tetro corridoio...")
+#####################################################################################################################
+#       BENCHMARKS                                                                                                  #
+#####################################################################################################################
+#   Measures generation (split by phase, then with each layout), frame rendering and the network handshake and      #
+#   turn round trip over a loopback socket pair, at several dungeon sizes. Dungeons use fixed seeds, so runs are    #
+#   comparable; results come out as JSON to be kept and compared between releases.                                  #
+#####################################################################################################################
 
-        # "Mechanics" rooms cases
-        elif room == RM_MNST:
-            print("Un mostro orribile ti si para davanti!")
+BENCH_SIZES = (25, 250, 1000)
+BENCH_PHASES = ("drunken_star", "get_empty", "place")  # DungeonGraph methods timed separately during generation
+BENCH_FRAMES = 100  # Frames rendered per sample
+BENCH_TURNS = 100  # Turn round trips per sample
 
-            if player.has_sword:
-                print("Usando la tua spada riesci a distruggere il mostro!")
-            else:
-                player.attacked(1)
-                print("Riesci a sconfiggere il mostro, ma subisci dei danni")
 
-            dungeon.set(dungeon.p1, RM_EMPTY)
-            msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+# Min, median and max of a list of durations in seconds, as milliseconds
+def bench_stats(samples):
+    return {"min_ms": min(samples) * 1000, "median_ms": statistics.median(samples) * 1000,
+            "max_ms": max(samples) * 1000}
 
-        elif room == RM_CHEST:
-            print("Trovi una cassa del tesoro davanti a te!")
 
-            if player.has_lockpick:
-                print("Utilizzando il grimaldello riesci ad aprire la cassa")
-                coin_amount = random.randrange(10, 100)
-                player.coin += coin_amount
+# Time multiplayer generation as a whole and each of BENCH_PHASES within it
+def bench_generation(size, repeat):
+    samples = {name: [] for name in ("init",) + BENCH_PHASES}
+    totals = {}
+    originals = {name: getattr(DungeonGraph, name) for name in BENCH_PHASES}
 
-                dungeon.set(dungeon.p1, RM_EMPTY)
-                msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+    def timed(name, method):
+        def wrapper(self, *args):
+            start = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                totals[name] += time.perf_counter() - start
+        return wrapper
+
+    try:
+        for name, method in originals.items():
+            setattr(DungeonGraph, name, timed(name, method))
+
+        for seed in range(repeat):
+            totals.update(dict.fromkeys(BENCH_PHASES, 0.0))
+            start = time.perf_counter()
+            DungeonGraph(True, size, seed)
+            samples["init"].append(time.perf_counter() - start)
+            for name in BENCH_PHASES:
+                samples[name].append(totals[name])
+    finally:
+        for name, method in originals.items():
+            setattr(DungeonGraph, name, method)
+
+    return {name: bench_stats(values) for name, values in samples.items()}
+
+
+# Time multiplayer generation with each of LAYOUTS, to pick the one to play with at a size
+def bench_layouts(size, repeat):
+    samples = {name: [] for name in LAYOUTS}
+    for name in LAYOUTS:
+        for seed in range(repeat):
+            start = time.perf_counter()
+            DungeonGraph(True, size, seed, layout=name)
+            samples[name].append(time.perf_counter() - start)
+    return {name: bench_stats(values) for name, values in samples.items()}
+
+
+# Time print_hidden around P1 with a fully discovered map, writing to memory instead of the terminal
+def bench_render(size, repeat):
+    dungeon = DungeonGraph(True, size, 0)
+    player = Player(size)
+    player.discovered[:] = b"\xff" * len(player.discovered)
+    samples = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(BENCH_FRAMES):
+                dungeon.print_hidden(dungeon.p1, DUNGEON_SIGHT, player)
+            samples.append((time.perf_counter() - start) / BENCH_FRAMES)
+
+    return bench_stats(samples)
+
+
+# Time the client side of the handshake, in seed and whole map mode, and a turn round trip with an echoing peer
+def bench_network(size, repeat):
+    dungeon = DungeonGraph(True, size, 0)
+    results = {}
+
+    for name, seed_handshake in (("handshake_seed", True), ("handshake_map", False)):
+        samples = []
+        for _ in range(repeat):
+            host, client = sck.socketpair()
+            with host, client:
+                sender = threading.Thread(target=send_dungeon, args=(host, dungeon, seed_handshake))
+                start = time.perf_counter()
+                sender.start()
+                receive_dungeon(client)
+                samples.append(time.perf_counter() - start)
+                sender.join()
+        results[name] = bench_stats(samples)
+
+    def echo(conn):
+        for _ in range(repeat * BENCH_TURNS):
+            send_messages(conn, recv_messages(conn))
+
+    # A typical turn: a cleared room and the new position
+    turn = [(MSG_CLR,) + dungeon.p1, (MSG_POS,) + dungeon.p1]
+    samples = []
+    host, client = sck.socketpair()
+    with host, client:
+        peer = threading.Thread(target=echo, args=(host,))
+        peer.start()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(BENCH_TURNS):
+                send_messages(client, turn)
+                recv_messages(client)
+            samples.append((time.perf_counter() - start) / BENCH_TURNS)
+        peer.join()
+    results["turn_round_trip"] = bench_stats(samples)
+
+    return results
+
+
+# Run every benchmark at the given sizes and return the results as a JSON-friendly dict
+def bench(sizes=BENCH_SIZES, repeat=5):
+    results = {"python": platform.python_version(), "platform": platform.platform(), "repeat": repeat, "sizes": {}}
+    for size in sizes:
+        results["sizes"][str(size)] = {
+            "generation": bench_generation(size, repeat),
+            "layouts": bench_layouts(size, repeat),
+            "print_hidden": bench_render(size, repeat),
+            "network": bench_network(size, repeat),
+        }
+    return results
 
-            else:
-                print("La cassa è chiusa e non riesci ad aprirla")
 
-        elif room == RM_TRAP:
-            print("Questa stanza contiene una trappola!")
+#####################################################################################################################
+#       BALANCE SIMULATOR                                                                                           #
+#####################################################################################################################
+#   Plays many single player games with a scripted agent on every CPU core, for one or more sets of balance         #
+#   parameters (SIM_PARAMS), and sums up how they went. Game n of a run always uses seed + n for both the dungeon   #
+#   and the gameplay, so a run gives the same results whatever the number of workers.                               #
+#####################################################################################################################
 
-            if random.random() < 0.5:
-                print("Ti accorgi della trappola e riesci ad evitarla")
-            else:
-                if player.has_knife:
-                    print("Riesci a disinnescare la trappola col tuo coltello")
+SIM_PARAMS = {"PC_MNST": float, "PC_TRAP": float, "PC_QUIZ": float, "PC_CHEST": float,  # Tunable constants
+              "TRAP_AVOID_CHANCE": float, "GAS_CHANCE": float, "TREASURE_MIN": int, "TREASURE_MAX": int,
+              "HUNT_RANGE": int, "HUNT_BITE_CHANCE": float, "HUNT_PACE": int}
+SIM_CHUNK = 500  # Games per task handed to a worker
+SIM_MAX_TURNS = 2000  # Games still going after this many turns count as lost in the dungeon
+SIM_QUIZ_SKILL = 0.5  # The probability that an agent knows the answer to a quiz
+SIM_WANDER = 0.2  # The probability that the seeker takes a random step instead of heading for the exit
+SIM_QUIZZES = [("?", "!")]  # Agents don't read the questions
+SIM_AGENT_SALT = 1 << 40  # Offsets the agent seed from the game one, so their random streams differ
 
-                elif random.random() < 0.5:
-                    player.attacked(2)
-                    print("Una nube di gas velenoso ti avvolge")
 
-                else:
-                    player.coin = int(player.coin * 0.75)
-                    print("Il pavimento si apre sotto ai tuoi piedi.")
-                    print("Riesci a metterti in salvo ma parte del tuo bottino cade nel fosso")
+# Rooms next to the player that aren't walls
+def open_nearby(dungeon):
+    return [pos for pos in dungeon.get_nearby(dungeon.p1) if dungeon.get(pos) != RM_WALL]
 
-            dungeon.set(dungeon.p1, RM_EMPTY)
-            msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
 
-        elif room == RM_QUIZ:
-            print("Sulla parete è riportata una misteriosa incisione...")
-            quiz = random.choice(quizzes)
-            print(quiz[0])
-            ans = input().lower()
+def agent_answer(state, rng):
+    return ACT_ANSWER, state.quiz[1] if rng.random() < SIM_QUIZ_SKILL else ""
 
-            if ans == quiz[1]:
-                print("Si apre un'alcova e trovi un tesoro")
-                player.coin += random.randrange(10, 100)
 
-            elif random.random() < 0.5:
-                player.attacked(2)
-                print("Una nube di gas velenoso ti avvolge")
+# Heads for the exit along the distance field, with a random step now and then
+def agent_seeker(state, rng):
+    if state.waiting == WAIT_ANSWER:
+        return agent_answer(state, rng)
 
-            else:
-                player.coin = int(player.coin * 0.75)
-                print("Il pavimento si apre sotto ai tuoi piedi.")
-                print("Riesci a metterti in salvo ma parte del tuo bottino cade nel fosso")
+    dungeon = state.dungeon
+    options = open_nearby(dungeon)
+    if rng.random() < SIM_WANDER:
+        target = rng.choice(options)
+    else:
+        target = min(options, key=lambda pos: (dungeon.distance(pos) is None, dungeon.distance(pos)))
+    return ACT_MOVE, target[0] - dungeon.p1[0], target[1] - dungeon.p1[1]
 
-            dungeon.set(dungeon.p1, RM_EMPTY)
-            msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
 
-        # Item rooms cases
-        elif room == RM_COMP:
-            print("Trovi una bussola in questa stanza")
+# Random walk
+def agent_wanderer(state, rng):
+    if state.waiting == WAIT_ANSWER:
+        return agent_answer(state, rng)
 
-            if player.has_compass:
-                print("Ma ne hai già una..")
-            else:
-                player.has_compass = True
-                dungeon.set(dungeon.p1, RM_EMPTY)
-                msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+    target = rng.choice(open_nearby(state.dungeon))
+    return ACT_MOVE, target[0] - state.dungeon.p1[0], target[1] - state.dungeon.p1[1]
 
-        elif room == RM_SWRD:
-            print("Trovi una spada in questa stanza")
 
-            if player.has_sword:
-                print("Ma ne hai già una..")
-            else:
-                player.has_sword = True
-                dungeon.set(dungeon.p1, RM_EMPTY)
-                msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+SIM_AGENTS = {"seeker": agent_seeker, "wanderer": agent_wanderer}
 
-        elif room == RM_KNIFE:
-            print("Trovi un coltello in questa stanza")
 
-            if player.has_knife:
-                print("Ma ne hai già uno..")
-            else:
-                player.has_knife = True
-                dungeon.set(dungeon.p1, RM_EMPTY)
-                msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+def new_sim_stats():
+    return {"games": 0, "escaped": 0, "dead": 0, "lost": 0, "coins_at_exit": 0, "turns_to_exit": 0,
+            "pickup_orders": {}}
 
-        elif room == RM_LOCKP:
-            print("Trovi un grimaldello in questa stanza")
 
-            if player.has_lockpick:
-                print("Ma ne hai già uno..")
-            else:
-                player.has_lockpick = True
-                dungeon.set(dungeon.p1, RM_EMPTY)
-                msg_queue.append(MSG_CLR + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
+# Play one game and add its outcome to stats
+def simulate_game(agent, size, seed, stats):
+    state, _ = start(GameState(DungeonGraph(False, size, seed), Player(size), SIM_QUIZZES, seed=seed))
+    rng = random.Random(seed + SIM_AGENT_SALT)
+    pickups = ""
 
-        # Other cases
-        elif room == RM_EXIT:
-            escaped = True
+    while not state.over and state.turns < SIM_MAX_TURNS:
+        step(state, agent(state, rng))
+        for room in ITEMS:
+            if room not in pickups and getattr(state.player, ITEM_FLAGS[room]):
+                pickups += room
 
-            if multi:
-                msg_queue.append(MSG_ESC + " " + str(player.coin))   # Send escape message and Gold amount
+    stats["games"] += 1
+    if not state.over:
+        stats["lost"] += 1
+    elif not state.player.attacked(0):
+        stats["dead"] += 1
+    else:
+        stats["escaped"] += 1
+        stats["coins_at_exit"] += state.player.coin
+        stats["turns_to_exit"] += state.turns
+    stats["pickup_orders"][pickups] = stats["pickup_orders"].get(pickups, 0) + 1
 
-                if not opponent_escaped:  # First player to get out, must wait
-                    wait_opponent = True
-                else:
-                    print("Sei fuggito in tempo!")    # Second player to get out
 
-        else:
-            print("C'è qualcosa in questa stanza, ma non riesci a capire cosa...")
+# Worker task: play count games from first_seed with the given balance parameters
+def simulate_chunk(task):
+    params, agent, size, first_seed, count = task
+    globals().update(params)  # Workers are separate processes, and every task sets all of the parameters
 
-        if not escaped:
-            if exit_found:
-                print("Vedi l'uscita di fronte a te!")
+    stats = new_sim_stats()
+    for seed in range(first_seed, first_seed + count):
+        simulate_game(SIM_AGENTS[agent], size, seed, stats)
+    return stats
 
-            if turnback:
-                turnback = False
-                curr_tile = previous_tile
-                input("Decidi di tornare indietro... (premi un tasto)")
-            else:
-                previous_tile, curr_tile = move(curr_tile, conn, dungeon, player)
-            dungeon.p1 = curr_tile
 
-            if opponent_escaped and (movs_to_esc < 10):  # Opponent got out, only 10 moves left
-                movs_to_esc += 1
+def merge_sim_stats(total, stats):
+    for key, value in stats.items():
+        if key == "pickup_orders":
+            for order, count in value.items():
+                total[key][order] = total[key].get(order, 0) + count
+        else:
+            total[key] += value
+
+
+# Play games per parameter set, each set a dict of SIM_PARAMS overrides. Returns one summary per set
+def simulate(param_sets, games, seed=0, size=DUNGEON_SIZE, agent="seeker", workers=None):
+    defaults = {name: globals()[name] for name in SIM_PARAMS}
+    tasks = []
+    for index, overrides in enumerate(param_sets):
+        for first in range(0, games, SIM_CHUNK):
+            count = min(SIM_CHUNK, games - first)
+            tasks.append((index, (dict(defaults, **overrides), agent, size, seed + first, count)))
+
+    totals = [new_sim_stats() for _ in param_sets]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for (index, _), stats in zip(tasks, pool.map(simulate_chunk, [task for _, task in tasks])):
+            merge_sim_stats(totals[index], stats)
+
+    summaries = []
+    for overrides, total in zip(param_sets, totals):
+        escaped = max(total["escaped"], 1)
+        orders = sorted(total["pickup_orders"].items(), key=lambda item: (-item[1], item[0]))
+        summaries.append({
+            "params": dict(defaults, **overrides),
+            "games": total["games"],
+            "survival_rate": total["escaped"] / total["games"],
+            "death_rate": total["dead"] / total["games"],
+            "lost_rate": total["lost"] / total["games"],
+            "mean_coins_at_exit": total["coins_at_exit"] / escaped,
+            "mean_turns_to_exit": total["turns_to_exit"] / escaped,
+            "pickup_orders": {order or "-": count for order, count in orders},
+        })
+    return summaries
+
+
+# Parse a "NAME=VALUE,NAME=VALUE" parameter set for the simulate command
+def parse_sim_params(text):
+    params = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip().upper()
+        if name not in SIM_PARAMS:
+            raise argparse.ArgumentTypeError("unknown parameter %s, choose from %s" % (name, ", ".join(SIM_PARAMS)))
+        params[name] = SIM_PARAMS[name](value)
+    return params
 
-                if movs_to_esc == 10:
-                    print("Senti la porta chiudersi in lontananza, intrappolandoti per sempre...")
-                    player.attacked(player.health)  # DEAD X_X
 
-        if multi:
-            try:
-                # Queueing my position
-                msg_queue.append(MSG_POS + " " + str(dungeon.p1[0]) + " " + str(dungeon.p1[1]))
-
-                # Queueing whether I'm dead
-                if not player.attacked(0):
-                    msg_queue.append(MSG_DIE)
-
-                # Sending all pending messages
-                msg = ""
-                for strs in msg_queue:
-                    msg += strs + " "
-                conn.sendall(msg.encode())
-
-                # Receiving opponent data
-                print("Attendi la mossa del tuo avversario...")
-
-                while not (opponent_escaped or opponent_dead):
-                    msg = conn.recv(1024).decode()
-                    # print(msg) # <--- debug
-                    msg = msg.split(' ')
-
-                    for i in range(len(msg)):
-                        if msg[i] == MSG_POS:
-                            dungeon.p2 = int(msg[i+1]), int(msg[i+2])
-                        elif msg[i] == MSG_ESC:
-                            opponent_escaped = True  # First player got out
-                            opponent_gold = int(msg[i+1])
-                            break
-                        elif msg[i] == MSG_DIE:
-                            opponent_dead = True
-                            dungeon.p2 = None
-                            conn.close()
-                            multi = False
-                            break
-                        elif msg[i] == MSG_CLR:
-                            dungeon.set((int(msg[i+1]), int(msg[i+2])), RM_EMPTY)
-                            break
-
-                    # Keep receiving if you are waiting the opponent and said opponent didn't die yet.
-                    # All I wanted was a DO - WHILE.
-                    if not wait_opponent:
-                        break
+#####################################################################################################################
+#       PROFILING                                                                                                   #
+#####################################################################################################################
+#   With --profile, or the CHEAP_DUNGEONS_PROFILE environment variable, the functions in PROFILE_METHODS and        #
+#   PROFILE_FUNCTIONS are swapped for timed wrappers, and a summary is printed (or written as JSON) at exit. Times  #
+#   include nested calls: place runs within generate, recv_messages is mostly waiting for the other player. Nothing #
+#   is wrapped otherwise, so profiling costs nothing when it's off.                                                 #
+#####################################################################################################################
 
-            except ConnectionAbortedError:
-                print("Connessione chiusa da parte dell'avversario")
-                multi = False
-                dungeon.p2 = None
-                conn.close()
+PROFILE_ENV = "CHEAP_DUNGEONS_PROFILE"  # "1" to print the summary, or the path of a JSON file to write it to
+PROFILE_METHODS = ("generate", "carve_drunk", "carve_rooms", "carve_caves", "drunk_path", "connect_path", "get_empty",
+                   "place", "print", "print_hidden")
+PROFILE_FUNCTIONS = ("step", "enter_room", "send_dungeon", "receive_dungeon", "send_messages", "recv_messages")
 
-        if not player.attacked(0):
-            print("Sei morto.")
-            break
 
-    # END GAME LOOP #
+class Profiler:
+    def __init__(self, out=None):
+        self.out = out  # JSON file for the summary, or None to print it
+        self.timers = {}  # Name -> [calls, total seconds, longest call seconds]
+        self.counters = {}  # Name -> count
+        self.encounter_start = None  # When the running encounter began, for its round trip
 
-    if conn is not None:
-        conn.close()
+    def add(self, name, elapsed):
+        timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
 
-    if player.attacked(0):
-        print("Riesci finalmente a vedere la luce del giorno. Congratulazioni!")
-        if opponent_gold != -1:
-            print("Il tuo avversario ha raccimolato ben " + str(opponent_gold) + " monete d'oro.")
-            print("Hai raccimolato ben " + str(player.coin) + " monete d'oro.")
-            if opponent_gold > player.coin:
-                print("Il tuo avversario vince!")
-            else:
-                print("Hai vinto!")
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    # Swap the profiled functions for timed ones, for the rest of the run
+    def enable(self):
+        for name in PROFILE_METHODS:
+            setattr(DungeonGraph, name, self.timed(name, getattr(DungeonGraph, name)))
+        for name in PROFILE_FUNCTIONS:
+            globals()[name] = self.timed(name, globals()[name])
+
+        choose_move, receive_move, send_frame, recv_frame = choose, receive_encounter, send_messages, recv_messages
+
+        # Encounter round trip: from the player's choice until the encounter is settled with the opponent
+        def timed_choose(state, action, events):
+            self.encounter_start = time.perf_counter()
+            return choose_move(state, action, events)
+
+        def timed_receive(state, messages, events):
+            result = receive_move(state, messages, events)
+            if state.encounter is None and self.encounter_start is not None:
+                self.add("encounter round trip", time.perf_counter() - self.encounter_start)
+                self.encounter_start = None
+            return result
+
+        def counted_send(conn, messages):
+            self.count("messages sent", len(messages))
+            return send_frame(conn, messages)
+
+        def counted_recv(conn):
+            messages = recv_frame(conn)
+            self.count("messages received", len(messages))
+            return messages
+
+        globals().update(choose=timed_choose, receive_encounter=timed_receive, send_messages=counted_send,
+                         recv_messages=counted_recv)
+        atexit.register(self.dump)
+
+    def summary(self):
+        return {
+            "timers": {name: {"calls": calls, "total_ms": total * 1000, "mean_ms": total * 1000 / calls,
+                              "max_ms": longest * 1000}
+                       for name, (calls, total, longest) in sorted(self.timers.items(), key=lambda t: -t[1][1])},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def dump(self):
+        summary = self.summary()
+        if self.out:
+            with open(self.out, "w") as out:
+                out.write(json.dumps(summary, indent=2) + "\n")
+            return
+
+        print()
+        print("%-24s %8s %12s %10s %10s" % ("", "chiamate", "totale ms", "media ms", "max ms"))
+        for name, timer in summary["timers"].items():
+            print("%-24s %8d %12.2f %10.3f %10.3f" % (name, timer["calls"], timer["total_ms"], timer["mean_ms"],
+                                                     timer["max_ms"]))
+        for name, count in summary["counters"].items():
+            print("%-24s %8d" % (name, count))
+
+
+profiler = None  # The running Profiler, if any
+
+
+def main():
+    global renderer, TURN_TIMER, DUNGEON_LAYOUT, HUNTING, profiler
+    parser = argparse.ArgumentParser(description="Cheap Dungeons")
+    parser.add_argument("--ansi", action="store_true", help="repaint only what changed on screen at each turn")
+    parser.add_argument("--resume", nargs="?", const=SAVE_FILE, metavar="FILE",
+                        help="go on with a saved game (%s by default)" % SAVE_FILE)
+    parser.add_argument("--profile", nargs="?", const="1", default=os.environ.get(PROFILE_ENV), metavar="JSON",
+                        help="time generation, drawing, network and encounters, and print a summary at exit (or write "
+                             "it to the given JSON file). Same as setting %s" % PROFILE_ENV)
+    parser.add_argument("--layout", choices=LAYOUTS, default=DUNGEON_LAYOUT,
+                        help="how new dungeons are carved: drunken walks, rooms and corridors, or caves")
+    parser.add_argument("--hunt", action="store_true", help="monsters come after you, within %d steps" % HUNT_RANGE)
+    parser.add_argument("--turn-timer", type=float, metavar="SECONDS",
+                        help="in multiplayer, stand still when a turn isn't played within this time (the host's)")
+    parser.add_argument("--record", nargs="?", const=REPLAY_FILE, metavar="FILE",
+                        help="write a replay log of the game (%s by default)" % REPLAY_FILE)
+    commands = parser.add_subparsers(dest="command")
+
+    server_parser = commands.add_parser("server", help="host many multiplayer matches")
+    server_parser.add_argument("--port", type=int, default=MULTI_PORT)
+    server_parser.add_argument("--size", type=int, default=DUNGEON_SIZE, help="dungeon size per side")
+    server_parser.add_argument("--spectator-port", type=int, default=SPECTATOR_PORT)
+    server_parser.add_argument("--players", type=int, default=2, choices=range(2, 65), metavar="2-64",
+                               help="players per match. Matches of more than two need a bigger --size")
+
+    watch_parser = commands.add_parser("watch", help="watch a match on a server, with the whole map in sight")
+    watch_parser.add_argument("host")
+    watch_parser.add_argument("--port", type=int, default=SPECTATOR_PORT)
+
+    bench_parser = commands.add_parser("bench", help="measure generation, rendering and network times")
+    bench_parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_SIZES, help="dungeon sizes per side")
+    bench_parser.add_argument("--repeat", type=int, default=5, help="samples per measure")
+    bench_parser.add_argument("--out", help="JSON file to write the results to, instead of the standard output")
+
+    replay_parser = commands.add_parser("replay", help="play a recorded game again and time its turns")
+    replay_parser.add_argument("log", nargs="?", default=REPLAY_FILE, help="replay log (%s by default)" % REPLAY_FILE)
+    replay_parser.add_argument("--quizzes", default="quiz.txt", help="quiz bank the game was played with")
+    replay_parser.add_argument("--out", help="JSON file to write the report to, instead of the standard output")
+
+    sim_parser = commands.add_parser("simulate", help="play many scripted games to tune the game balance")
+    sim_parser.add_argument("--games", type=int, default=10000, help="games per parameter set")
+    sim_parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    sim_parser.add_argument("--size", type=int, default=DUNGEON_SIZE, help="dungeon size per side")
+    sim_parser.add_argument("--agent", choices=SIM_AGENTS, default="seeker")
+    sim_parser.add_argument("--workers", type=int, help="worker processes, one per CPU core by default")
+    sim_parser.add_argument("--set", dest="param_sets", type=parse_sim_params, action="append",
+                            metavar="NAME=VALUE,...",
+                            help="a parameter set to try, can be repeated. Defaults to the current constants")
+    sim_parser.add_argument("--out", help="JSON file to write the full results to")
+
+    args = parser.parse_args()
+    if args.command == "server" and args.players > 2 and args.size < DungeonGraph.min_size(args.players):
+        parser.error("%d players need --size %d at least" % (args.players, DungeonGraph.min_size(args.players)))
+    renderer = FrameRenderer(args.ansi)
+    TURN_TIMER = args.turn_timer
+    DUNGEON_LAYOUT = args.layout
+    HUNTING = args.hunt
+    if args.profile and args.profile != "0":
+        profiler = Profiler(None if args.profile == "1" else args.profile)
+        profiler.enable()
+    if args.command == "server":
+        serve(args.port, args.size, args.spectator_port, args.players)
+    elif args.command == "watch":
+        watch(args.host, args.port)
+    elif args.command == "bench":
+        results = json.dumps(bench(args.sizes, args.repeat), indent=2)
+        if args.out:
+            with open(args.out, "w") as out:
+                out.write(results + "\n")
+        else:
+            print(results)
+    elif args.command == "replay":
+        report = replay(args.log, QuizBank(args.quizzes))
+        if args.out:
+            with open(args.out, "w") as out:
+                out.write(json.dumps(report, indent=2) + "\n")
+        else:
+            print(json.dumps(report, indent=2))
+        if report["verified"] is False:
+            sys.exit(1)  # The game went differently
+    elif args.command == "simulate":
+        summaries = simulate(args.param_sets or [{}], args.games, args.seed, args.size, args.agent, args.workers)
+        for summary in summaries:
+            print(", ".join("%s=%s" % item for item in summary["params"].items()))
+            print("  %d partite: %.1f%% fuggiti, %.1f%% morti, %.1f%% persi. All'uscita %.1f monete in %.1f turni"
+                  % (summary["games"], summary["survival_rate"] * 100, summary["death_rate"] * 100,
+                     summary["lost_rate"] * 100, summary["mean_coins_at_exit"], summary["mean_turns_to_exit"]))
+            print("  Oggetti raccolti: " + ", ".join("%s %d" % item for item in
+                                                     list(summary["pickup_orders"].items())[:5]))
+        if args.out:
+            with open(args.out, "w") as out:
+                out.write(json.dumps(summaries, indent=2) + "\n")
+    else:
+        play(args.resume, args.record)
 
-    input("Premi un tasto per uscire...")
 
 #############
 #    RUN    #
 #############
 
-play()
+if __name__ == "__main__":
+    main()